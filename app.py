@@ -1,38 +1,125 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for, send_from_directory
-from flask_cors import CORS
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Text, func
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, render_template, session, redirect, url_for, send_from_directory
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, Date, DateTime, Float, ForeignKey, Text, Index, UniqueConstraint, and_, event, func, insert, inspect, literal, or_, select, text, union_all, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.orm import sessionmaker
+from datetime import datetime, timedelta
 import os
+import atexit
+import csv
+import hashlib
+import io
 import json
-import openai
-from dotenv import load_dotenv
+import math
 import time
 from werkzeug.security import generate_password_hash, check_password_hash # CORRECTED: Use stronger hashing
 from werkzeug.utils import secure_filename
+import click
 import random
+import secrets
 import string
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
-# Configure OpenAI
-# It's recommended to use environment variables in production
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
-app = Flask(__name__, static_folder='static')
-app.secret_key = 'your-secret-key-here'
-CORS(app)
+# Heavy dependencies (openai, dotenv, flask_cors) are imported on first use so that
+# importing this module stays cheap; see create_app() and get_openai().
+bp = Blueprint('main', __name__)
 
 # File upload configuration
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# Create uploads directory if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(os.path.join(UPLOAD_FOLDER, 'questions'), exist_ok=True)
-os.makedirs(os.path.join(UPLOAD_FOLDER, 'answers'), exist_ok=True)
+def load_settings():
+    """Read tunables from the environment; create_app() runs this again after loading .env"""
+    global DATABASE_URL
+    global DOBBY_HISTORY_TURNS, DOBBY_PROMPT_TOKEN_BUDGET, DOBBY_SUMMARY_BATCH, DOBBY_SUMMARY_MAX_TOKENS
+    global REWARD_POOL_TARGET, REWARD_POOL_LOW_WATER
+    global DOUBT_LEASE_SECONDS, DOUBT_QUEUE_REFRESH_SECONDS
+    global ANALYTICS_ROLLUP_DELAY_SECONDS
+    global DOUBT_ARCHIVE_AFTER_DAYS, DOUBT_ARCHIVE_BATCH, DB_MAINTENANCE_INTERVAL_SECONDS, DB_VACUUM_PAGES
+    global EXPORT_BATCH_ROWS, ROSTER_IMPORT_BATCH, ROSTER_HASH_WORKERS
+    global LLM_TIMEOUT_SECONDS, LLM_HEDGE_AFTER_SECONDS, LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN_SECONDS
+    global LLM_MAX_CONCURRENCY, LLM_CACHE_SIZE
+    global AI_USER_BUCKET_CAPACITY, AI_USER_REFILL_PER_MINUTE, AI_GLOBAL_BUCKET_CAPACITY, AI_GLOBAL_REFILL_PER_MINUTE
+    global AI_USAGE_FLUSH_SECONDS
+    global JOB_WORKERS, JOB_WORKER_MODE, JOB_POLL_SECONDS, JOB_MAX_ATTEMPTS, JOB_BACKOFF_SECONDS, JOB_VISIBILITY_TIMEOUT
+
+    DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///./ai_education.db')
+
+    # Dobby conversation memory configuration
+    DOBBY_HISTORY_TURNS = int(os.getenv('DOBBY_HISTORY_TURNS', 6))  # Recent user/assistant pairs kept verbatim
+    DOBBY_PROMPT_TOKEN_BUDGET = int(os.getenv('DOBBY_PROMPT_TOKEN_BUDGET', 2000))  # Cap on prompt tokens per call
+    DOBBY_SUMMARY_BATCH = int(os.getenv('DOBBY_SUMMARY_BATCH', 4))  # Older messages needed before re-summarizing
+    DOBBY_SUMMARY_MAX_TOKENS = 250
+
+    # Reward redemption configuration
+    REWARD_POOL_TARGET = int(os.getenv('REWARD_POOL_TARGET', 500))  # Codes kept pre-minted per reward type
+    REWARD_POOL_LOW_WATER = int(os.getenv('REWARD_POOL_LOW_WATER', 100))  # Refill once a pool drops below this
+
+    # Teacher doubt routing configuration
+    DOUBT_LEASE_SECONDS = int(os.getenv('DOUBT_LEASE_SECONDS', 600))  # How long a claimed doubt stays with one teacher
+    DOUBT_QUEUE_REFRESH_SECONDS = int(os.getenv('DOUBT_QUEUE_REFRESH_SECONDS', 60))  # Resync with other workers' writes
+
+    # Model provider resilience configuration (OPENAI_API_BASE points the client at a stub server)
+    LLM_TIMEOUT_SECONDS = float(os.getenv('LLM_TIMEOUT_SECONDS', 20))  # Give up on a call, hedge included, after this
+    LLM_HEDGE_AFTER_SECONDS = float(os.getenv('LLM_HEDGE_AFTER_SECONDS', 3))  # Hedge deadline until p95 has enough samples
+    LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', 5))  # Consecutive failed calls that open the breaker
+    LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv('LLM_BREAKER_COOLDOWN_SECONDS', 30))  # Fail fast this long, then probe
+    LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 16))  # Threads available for provider calls and hedges
+    LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', 1000))  # Recent answers kept for degraded replies
+
+    # AI rate limits (token buckets; per-role rows in role_quotas override the per-user defaults)
+    AI_USER_BUCKET_CAPACITY = float(os.getenv('AI_USER_BUCKET_CAPACITY', 20))  # Burst of AI requests one user may make
+    AI_USER_REFILL_PER_MINUTE = float(os.getenv('AI_USER_REFILL_PER_MINUTE', 6))
+    AI_GLOBAL_BUCKET_CAPACITY = float(os.getenv('AI_GLOBAL_BUCKET_CAPACITY', 200))  # Shared by everyone; keep under the OpenAI limit
+    AI_GLOBAL_REFILL_PER_MINUTE = float(os.getenv('AI_GLOBAL_REFILL_PER_MINUTE', 120))
+    AI_USAGE_FLUSH_SECONDS = float(os.getenv('AI_USAGE_FLUSH_SECONDS', 30))  # Token accounting is written in batches this often
+
+    # Teacher analytics configuration
+    ANALYTICS_ROLLUP_DELAY_SECONDS = int(os.getenv('ANALYTICS_ROLLUP_DELAY_SECONDS', 60))  # Batch rollup refreshes this long
+
+    # Archival and database maintenance configuration
+    DOUBT_ARCHIVE_AFTER_DAYS = int(os.getenv('DOUBT_ARCHIVE_AFTER_DAYS', 90))  # Resolved doubts older than this move to doubts_archive
+    DOUBT_ARCHIVE_BATCH = int(os.getenv('DOUBT_ARCHIVE_BATCH', 500))  # Rows moved per transaction
+    DB_MAINTENANCE_INTERVAL_SECONDS = int(os.getenv('DB_MAINTENANCE_INTERVAL_SECONDS', 86400))  # 0 disables the schedule
+    DB_VACUUM_PAGES = int(os.getenv('DB_VACUUM_PAGES', 2000))  # Free pages released per maintenance run
+
+    # Bulk export and roster import configuration
+    EXPORT_BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', 1000))  # Rows read per page while streaming an export
+    ROSTER_IMPORT_BATCH = int(os.getenv('ROSTER_IMPORT_BATCH', 500))  # Accounts inserted per transaction
+    ROSTER_HASH_WORKERS = int(os.getenv('ROSTER_HASH_WORKERS', os.cpu_count() or 2))  # Processes hashing passwords
+
+    # Background job queue configuration
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))  # Worker threads per app process; 0 disables in-process workers
+    JOB_WORKER_MODE = os.getenv('JOB_WORKER_MODE', 'thread')  # 'thread' or 'process'
+    JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', 2))
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+    JOB_BACKOFF_SECONDS = float(os.getenv('JOB_BACKOFF_SECONDS', 5))  # First retry delay, doubled per attempt
+    JOB_VISIBILITY_TIMEOUT = int(os.getenv('JOB_VISIBILITY_TIMEOUT', 900))  # Running jobs older than this are requeued
+
+load_settings()
+
+# Reward redemption catalogue
+REWARD_TYPES = ['Amazon', 'Giftshop']
+REWARD_POINTS_COST = 50
+
+DOBBY_UNAVAILABLE_REPLY = ("Dobby can't reach its thinking cap right now. Please try again in a minute, "
+                           "or submit your question as a doubt so a teacher can help.")
+
+_openai = None
+
+def get_openai():
+    """Import and configure the OpenAI client on first use"""
+    global _openai
+    if _openai is None:
+        import openai
+        # It's recommended to use environment variables in production
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        _openai = openai
+    return _openai
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
@@ -47,7 +134,7 @@ def save_uploaded_file(file, folder):
         name, ext = os.path.splitext(filename)
         unique_filename = f"{name}_{timestamp}{ext}"
         
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], folder, unique_filename)
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], folder, unique_filename)
         file.save(file_path)
         return unique_filename
     return None
@@ -55,10 +142,19 @@ def save_uploaded_file(file, folder):
 # ============================================================================
 # DATABASE SETUP (SQLAlchemy)
 # ============================================================================
-DATABASE_URL = "sqlite:///./ai_education.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 Base = declarative_base()
+engine = None
+
+def init_engine(database_url=None):
+    """Create the engine for database_url (DATABASE_URL by default) and bind SessionLocal to it"""
+    global engine
+    if engine is not None:
+        engine.dispose()
+    engine = create_engine(database_url or DATABASE_URL, connect_args={"check_same_thread": False})
+    SessionLocal.configure(bind=engine)
+    return engine
+
 
 # ============================================================================
 # DATABASE MODELS
@@ -104,7 +200,7 @@ class Doubt(Base):
     teacher_id = Column(Integer, ForeignKey("profiles.id"), nullable=True)
     answer = Column(Text, nullable=True)
     answer_image = Column(String, nullable=True)  # Path to uploaded answer image
-    answered_at = Column(DateTime, nullable=True)
+    answered_at = Column(DateTime, nullable=True, index=True)
     rating = Column(Integer, nullable=True)  # 1-5 stars
     upvoted = Column(Boolean, default=False)
     downvoted = Column(Boolean, default=False)
@@ -113,8 +209,74 @@ class Doubt(Base):
     final_rating = Column(Integer, nullable=True)
     final_upvoted = Column(Boolean, default=False)
     points_awarded = Column(Integer, default=0)
+    idempotency_key = Column(String, nullable=True)  # Client-supplied key; a replayed submit returns the same doubt
+    content_hash = Column(String, nullable=True)  # Topic, question and image digest, for catching double-submits
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (
+        # Per-student history in order, and the oldest pending doubt per student for routing
+        Index('ix_doubts_student_created', 'student_id', 'created_at'),
+        # Covers the teacher stats aggregate, so it never touches the table rows
+        Index('ix_doubts_teacher_status', 'teacher_id', 'status', 'points_awarded', 'final_rating'),
+        Index('ix_doubts_status_created', 'status', 'created_at'),
+        Index('uq_doubts_student_idempotency_key', 'student_id', 'idempotency_key', unique=True),
+        # At most one pending copy of the same doubt per student
+        Index('uq_doubts_pending_content', 'student_id', 'content_hash', unique=True,
+              sqlite_where=text("status = 'pending'")),
+    )
+
+class ArchivedDoubt(Base):
+    """Resolved doubts moved out of the hot doubts table; same columns plus archived_at"""
+    __tablename__ = "doubts_archive"
+    id = Column(Integer, primary_key=True)
+    student_id = Column(Integer, ForeignKey("profiles.id"))
+    topic = Column(String, nullable=False)
+    question = Column(Text, nullable=False)
+    question_image = Column(String, nullable=True)
+    status = Column(String, default='resolved')
+    teacher_id = Column(Integer, ForeignKey("profiles.id"), nullable=True)
+    answer = Column(Text, nullable=True)
+    answer_image = Column(String, nullable=True)
+    answered_at = Column(DateTime, nullable=True)
+    rating = Column(Integer, nullable=True)
+    upvoted = Column(Boolean, default=False)
+    downvoted = Column(Boolean, default=False)
+    student_comment = Column(Text, nullable=True)
+    teacher_reply = Column(Text, nullable=True)
+    final_rating = Column(Integer, nullable=True)
+    final_upvoted = Column(Boolean, default=False)
+    points_awarded = Column(Integer, default=0)
+    idempotency_key = Column(String, nullable=True)
+    content_hash = Column(String, nullable=True)
+    created_at = Column(DateTime)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index('ix_doubts_archive_student_created', 'student_id', 'created_at'),
+        Index('ix_doubts_archive_teacher_status', 'teacher_id', 'status', 'points_awarded', 'final_rating'),
+    )
+
+class DoubtDraft(Base):
+    """AI-written starting point for a teacher's answer, one per doubt"""
+    __tablename__ = "doubt_drafts"
+    doubt_id = Column(Integer, ForeignKey("doubts.id"), primary_key=True)
+    question_hash = Column(String, nullable=False)
+    draft = Column(Text, nullable=False)
+    cached = Column(Boolean, default=False)  # Copied from an identical earlier question
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class DraftCache(Base):
+    __tablename__ = "draft_cache"
+    question_hash = Column(String, primary_key=True)  # sha256 of the normalised topic and question
+    status = Column(String, nullable=False)  # generating, ready
+    draft = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class DoubtLease(Base):
+    __tablename__ = "doubt_leases"
+    doubt_id = Column(Integer, ForeignKey("doubts.id"), primary_key=True)
+    teacher_id = Column(Integer, ForeignKey("profiles.id"), nullable=False)
+    claimed_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+
 class QnASession(Base):
     __tablename__ = "qna_sessions"
     id = Column(Integer, primary_key=True, index=True)
@@ -124,6 +286,35 @@ class QnASession(Base):
     correct_answers = Column(Integer, default=0)
     points_earned = Column(Integer, default=0)
     completed = Column(Boolean, default=False)
+    item_ids = Column(Text, nullable=True)  # JSON list of quiz_items ids served, in order
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class QuizItem(Base):
+    __tablename__ = "quiz_items"
+    id = Column(Integer, primary_key=True, index=True)
+    topic_key = Column(String, nullable=False)
+    difficulty = Column(String, nullable=False)  # easy, medium or hard wording of the question
+    position = Column(Integer, nullable=False)
+    question = Column(Text, nullable=False)  # JSON question, options, correct_answer, explanation
+    rating = Column(Float, nullable=False)  # Item difficulty on the logit scale
+    attempts = Column(Integer, default=0)
+    __table_args__ = (UniqueConstraint('topic_key', 'difficulty', 'position', name='uq_quiz_item_slot'),)
+
+class TopicMastery(Base):
+    __tablename__ = "topic_mastery"
+    student_id = Column(Integer, ForeignKey("profiles.id"), primary_key=True)
+    topic_key = Column(String, primary_key=True)
+    rating = Column(Float, default=0.0)  # Student ability on the logit scale
+    attempts = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class QuizAnswer(Base):
+    __tablename__ = "quiz_answers"
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer, ForeignKey("qna_sessions.id"), nullable=False)
+    student_id = Column(Integer, ForeignKey("profiles.id"), nullable=False)
+    item_id = Column(Integer, ForeignKey("quiz_items.id"), nullable=False)
+    correct = Column(Boolean, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class PointsTransaction(Base):
@@ -143,8 +334,142 @@ class RewardCode(Base):
     points_spent = Column(Integer, nullable=False, default=50)
     redeemed_at = Column(DateTime, default=datetime.utcnow)
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+class RewardCodePool(Base):
+    __tablename__ = "reward_code_pool"
+    id = Column(Integer, primary_key=True, index=True)
+    reward_type = Column(String, nullable=False)
+    code = Column(String, unique=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index('ix_reward_code_pool_type_id', 'reward_type', 'id'),)
+
+class RedemptionRequest(Base):
+    __tablename__ = "redemption_requests"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("profiles.id"), nullable=False)
+    idempotency_key = Column(String, nullable=False)
+    reward_code_id = Column(Integer, ForeignKey("reward_codes.id"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (UniqueConstraint('user_id', 'idempotency_key', name='uq_redemption_user_key'),)
+
+class ChatThread(Base):
+    __tablename__ = "chat_threads"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("profiles.id"), nullable=False, index=True)
+    title = Column(String, nullable=True)
+    summary = Column(Text, nullable=True)  # Running summary of turns older than the verbatim window
+    summarized_through_id = Column(Integer, default=0)  # Last ChatMessage.id folded into the summary
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ChatMessage(Base):
+    __tablename__ = "chat_messages"
+    id = Column(Integer, primary_key=True, index=True)
+    thread_id = Column(Integer, ForeignKey("chat_threads.id"), nullable=False)
+    role = Column(String, nullable=False)  # user, assistant
+    content = Column(Text, nullable=False)
+    token_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index('ix_chat_messages_thread_id_id', 'thread_id', 'id'),)
+
+class FlashcardDeck(Base):
+    __tablename__ = "flashcard_decks"
+    id = Column(Integer, primary_key=True, index=True)
+    student_id = Column(Integer, ForeignKey("profiles.id"), nullable=False)
+    topic = Column(String, nullable=False)
+    topic_key = Column(String, nullable=False)  # Normalized topic used to find an existing deck
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (UniqueConstraint('student_id', 'topic_key', name='uq_flashcard_deck_student_topic'),)
+
+class Flashcard(Base):
+    __tablename__ = "flashcards"
+    id = Column(Integer, primary_key=True, index=True)
+    deck_id = Column(Integer, ForeignKey("flashcard_decks.id"), nullable=False, index=True)
+    student_id = Column(Integer, ForeignKey("profiles.id"), nullable=False)
+    term = Column(String, nullable=False)
+    definition = Column(Text, nullable=False)
+    easiness = Column(Float, default=2.5)  # SM-2 easiness factor
+    interval_days = Column(Integer, default=0)
+    repetitions = Column(Integer, default=0)  # Consecutive successful reviews
+    due_at = Column(DateTime, default=datetime.utcnow)
+    last_reviewed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index('ix_flashcards_student_due', 'student_id', 'due_at'),)
+
+class DoubtDailyRollup(Base):
+    __tablename__ = "doubt_daily_rollups"
+    day = Column(Date, primary_key=True)
+    topic_key = Column(String, primary_key=True)
+    teacher_id = Column(Integer, primary_key=True)  # 0 while a doubt is unassigned
+    asked = Column(Integer, default=0)  # Counted on the day the doubt was created
+    answered = Column(Integer, default=0)  # Counted, with the columns below, on the day it was answered
+    turnaround_seconds = Column(Float, default=0.0)  # Sum of answered_at - created_at
+    rated = Column(Integer, default=0)
+    rating_1 = Column(Integer, default=0)
+    rating_2 = Column(Integer, default=0)
+    rating_3 = Column(Integer, default=0)
+    rating_4 = Column(Integer, default=0)
+    rating_5 = Column(Integer, default=0)
+    points_awarded = Column(Integer, default=0)
+
+class QuizDailyRollup(Base):
+    __tablename__ = "quiz_daily_rollups"
+    day = Column(Date, primary_key=True)
+    topic_key = Column(String, primary_key=True)
+    sessions = Column(Integer, default=0)  # Completed quizzes started that day
+    questions = Column(Integer, default=0)
+    correct = Column(Integer, default=0)
+    points_earned = Column(Integer, default=0)
+
+class AnalyticsDirtyDay(Base):
+    __tablename__ = "analytics_dirty_days"
+    day = Column(Date, primary_key=True)  # Rollups for this day are stale
+
+class RateBucket(Base):
+    __tablename__ = "rate_buckets"
+    key = Column(String, primary_key=True)  # 'user:<id>' or 'global'
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)  # Unix time of the last refill
+
+class RoleQuota(Base):
+    __tablename__ = "role_quotas"
+    role = Column(String, primary_key=True)
+    capacity = Column(Float, nullable=False)
+    refill_per_minute = Column(Float, nullable=False)
+    updated_by = Column(Integer, ForeignKey("profiles.id"), nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class AIUsage(Base):
+    __tablename__ = "ai_usage"
+    user_id = Column(Integer, ForeignKey("profiles.id"), primary_key=True)  # 0 for system work
+    day = Column(Date, primary_key=True)
+    purpose = Column(String, primary_key=True)
+    requests = Column(Integer, default=0)  # Provider requests, hedges included
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+
+class Job(Base):
+    __tablename__ = "jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    payload = Column(Text, nullable=False, default='{}')  # JSON kwargs for the handler
+    status = Column(String, default='queued')  # queued, running, done, failed
+    priority = Column(Integer, default=0)  # Higher runs first
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    dedup_key = Column(String, nullable=True)
+    user_id = Column(Integer, ForeignKey("profiles.id"), nullable=True)  # Who may poll the job's status
+    run_at = Column(DateTime, default=datetime.utcnow)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    result = Column(Text, nullable=True)  # JSON return value of the handler
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (
+        Index('ix_jobs_ready', 'status', 'priority', 'run_at'),
+        Index('ix_jobs_active_dedup_key', 'dedup_key', unique=True,
+              sqlite_where=text("status IN ('queued', 'running')")),
+    )
 
 # ============================================================================
 # DATABASE HELPER FUNCTIONS
@@ -209,58 +534,825 @@ def generate_fallback_questions(topic, difficulty):
     ]
     return fallback_questions
 
+# ============================================================================
+# BACKGROUND JOB QUEUE
+# ============================================================================
+JOB_HANDLERS = {}
+_job_wakeup = threading.Event()
+
+def job_handler(kind):
+    """Register a function as the handler for a job kind; it is called with the payload as kwargs"""
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+def enqueue_job(kind, payload=None, priority=0, dedup_key=None, delay_seconds=0, max_attempts=None, user_id=None):
+    """Persist a job and wake the local workers; returns the job id.
+
+    While a job with the same dedup_key is queued or running, the existing job's
+    id is returned instead of adding another. This opens its own session, so call
+    it after the request's transaction has committed (SQLite allows one writer).
+    """
+    db = SessionLocal()
+    try:
+        job = Job(
+            kind=kind,
+            payload=json.dumps(payload or {}),
+            priority=priority,
+            dedup_key=dedup_key,
+            run_at=datetime.utcnow() + timedelta(seconds=delay_seconds),
+            max_attempts=max_attempts or JOB_MAX_ATTEMPTS,
+            user_id=user_id
+        )
+        db.add(job)
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            existing = db.query(Job.id).filter(Job.dedup_key == dedup_key, Job.status.in_(['queued', 'running'])).scalar()
+            if existing:
+                return existing
+            # The duplicate finished between our insert and lookup; queue this one after all
+            return enqueue_job(kind, payload, priority, dedup_key, delay_seconds, max_attempts, user_id)
+        _job_wakeup.set()
+        return job.id
+    finally:
+        db.close()
+
+def claim_next_job(worker_name):
+    """Atomically mark the most urgent due job as running and return (id, kind, payload, attempts, max_attempts)"""
+    now = datetime.utcnow()
+    next_id = select(Job.id).where(Job.status == 'queued', Job.run_at <= now)\
+        .order_by(Job.priority.desc(), Job.run_at, Job.id).limit(1).scalar_subquery()
+    stmt = update(Job).where(Job.id == next_id, Job.status == 'queued').values(
+        status='running', locked_by=worker_name, locked_at=now, attempts=Job.attempts + 1, updated_at=now
+    ).returning(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+    with engine.begin() as conn:
+        return conn.execute(stmt).first()
+
+def finish_job(job_id, result=None, error=None, attempts=0, max_attempts=0):
+    """Record a job's outcome; failures are retried with exponential backoff until max_attempts"""
+    now = datetime.utcnow()
+    values = {'updated_at': now, 'locked_by': None, 'locked_at': None}
+    if error is None:
+        values.update(status='done', result=json.dumps(result), last_error=None)
+    elif attempts < max_attempts:
+        backoff = min(JOB_BACKOFF_SECONDS * 2 ** (attempts - 1), 3600) * random.uniform(0.5, 1.5)
+        values.update(status='queued', last_error=error, run_at=now + timedelta(seconds=backoff))
+    else:
+        values.update(status='failed', last_error=error)
+    with engine.begin() as conn:
+        conn.execute(update(Job).where(Job.id == job_id).values(**values))
+
+def requeue_stale_jobs():
+    """Put back jobs whose worker died mid-run (locked longer than JOB_VISIBILITY_TIMEOUT)"""
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_VISIBILITY_TIMEOUT)
+    with engine.begin() as conn:
+        return conn.execute(update(Job).where(Job.status == 'running', Job.locked_at < cutoff)
+                            .values(status='queued', locked_by=None, locked_at=None)).rowcount
+
+def schedule_periodic_jobs():
+    """Keep one future run of each recurring job queued; the dedup key makes this safe to call often"""
+    try:
+        if DB_MAINTENANCE_INTERVAL_SECONDS > 0:
+            enqueue_job('maintain_database', priority=-10, dedup_key='maintain_database',
+                        delay_seconds=DB_MAINTENANCE_INTERVAL_SECONDS)
+    except Exception as e:
+        print(f"Error scheduling periodic jobs: {e}")
+
+def run_job_handler(kind, payload):
+    """Entry point for a job in a worker thread or process"""
+    return JOB_HANDLERS[kind](**payload)
+
+def _init_job_process(database_url):
+    # Handler processes start from a fresh import, so they need their own engine
+    init_engine(database_url)
+
+class JobWorkerPool:
+    """Worker threads that claim jobs from the jobs table and run their handlers.
+
+    In 'process' mode the threads only claim and record jobs, and handlers run
+    in a process pool so CPU-heavy work doesn't contend for the GIL.
+    """
+
+    def __init__(self, workers=None, mode=None, poll_seconds=None):
+        self.workers = JOB_WORKERS if workers is None else workers
+        self.mode = mode or JOB_WORKER_MODE
+        self.poll_seconds = poll_seconds or JOB_POLL_SECONDS
+        self.threads = []
+        self.executor = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        if self.mode == 'process':
+            # forkserver: forking a process that already runs worker threads can deadlock the child
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_job_process,
+                                                initargs=(str(engine.url),), mp_context=multiprocessing.get_context('forkserver'))
+        requeue_stale_jobs()
+        schedule_periodic_jobs()
+        for i in range(self.workers):
+            name = f"{os.getpid()}-{i}"
+            thread = threading.Thread(target=self._run, args=(name,), name=f'brainyac-job-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        _job_wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+    def _run(self, name):
+        idle_polls = 0
+        while not self.stopping.is_set():
+            try:
+                job = claim_next_job(name)
+            except Exception as e:
+                print(f"Error claiming job: {e}")
+                job = None
+            if not job:
+                idle_polls += 1
+                if idle_polls % 100 == 0:
+                    requeue_stale_jobs()
+                    schedule_periodic_jobs()
+                _job_wakeup.wait(self.poll_seconds)
+                _job_wakeup.clear()
+                continue
+            idle_polls = 0
+            try:
+                self._execute(job)
+            except Exception as e:
+                # Leave the job locked; requeue_stale_jobs hands it out again later
+                print(f"Error recording result of job {job[0]}: {e}")
+
+    def _execute(self, job):
+        job_id, kind, payload, attempts, max_attempts = job
+        try:
+            if kind not in JOB_HANDLERS:
+                raise ValueError(f"No handler registered for job kind '{kind}'")
+            if self.executor:
+                result = self.executor.submit(run_job_handler, kind, json.loads(payload)).result()
+            else:
+                result = run_job_handler(kind, json.loads(payload))
+            finish_job(job_id, result=result)
+        except Exception as e:
+            print(f"Job {job_id} ({kind}) failed on attempt {attempts}: {e}")
+            finish_job(job_id, error=f"{type(e).__name__}: {e}", attempts=attempts, max_attempts=max_attempts)
+
+job_workers = None
+_job_workers_lock = threading.Lock()
+
+def start_job_workers():
+    """Start this process's worker pool once; JOB_WORKERS=0 leaves jobs to a dedicated worker process"""
+    global job_workers
+    with _job_workers_lock:
+        if job_workers is None and JOB_WORKERS > 0:
+            job_workers = JobWorkerPool()
+            job_workers.start()
+
+@bp.before_app_request
+def _ensure_job_workers():
+    if job_workers is None:
+        start_job_workers()
+
+def format_job(job, include_payload=False):
+    formatted = {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'priority': job.priority,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'run_at': job.run_at.isoformat(),
+        'last_error': job.last_error,
+        'result': json.loads(job.result) if job.result else None,
+        'created_at': job.created_at.isoformat(),
+        'updated_at': job.updated_at.isoformat() if job.updated_at else None
+    }
+    if include_payload:
+        formatted['payload'] = json.loads(job.payload)
+    return formatted
+
+@bp.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """Status and result of a job; users see their own jobs, teachers and admins see any"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    db = SessionLocal()
+    try:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        is_staff = session.get('user_role') in ['teacher', 'admin']
+        if not job or (job.user_id != session['user_id'] and not is_staff):
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        return jsonify({'success': True, 'job': format_job(job, include_payload=is_staff)})
+    finally:
+        db.close()
+
+@bp.route('/api/jobs/stats', methods=['GET'])
+def get_job_stats():
+    """Queue depth per status and kind, plus the age of the oldest due job"""
+    if 'user_id' not in session or session.get('user_role') not in ['teacher', 'admin']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        counts = db.query(Job.kind, Job.status, func.count(Job.id)).group_by(Job.kind, Job.status).all()
+        oldest_due = db.query(func.min(Job.run_at)).filter(Job.status == 'queued', Job.run_at <= now).scalar()
+    finally:
+        db.close()
+    
+    by_kind = {}
+    for kind, status, count in counts:
+        by_kind.setdefault(kind, {})[status] = count
+    return jsonify({
+        'success': True,
+        'stats': {
+            'by_kind': by_kind,
+            'oldest_due_seconds': int((now - oldest_due).total_seconds()) if oldest_due else 0,
+            'workers': len(job_workers.threads) if job_workers else 0
+        }
+    })
+
+@job_handler('award_points')
+def award_points_job(user_id, points, reason):
+    award_points(user_id, points, reason)
+
+@job_handler('increment_counter')
+def increment_counter_job(user_id, field):
+    """Bump one of the activity counters on a profile"""
+    if field not in ['doubts_asked', 'qna_sessions']:
+        raise ValueError(f"Unknown counter '{field}'")
+    db = SessionLocal()
+    try:
+        column = getattr(Profile, field)
+        db.query(Profile).filter(Profile.id == user_id).update({column: func.coalesce(column, 0) + 1}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+# ============================================================================
+# LLM RESILIENCE
+# ============================================================================
+# Every provider call goes through llm_chat(). Calls are bounded by a deadline.
+# A duplicate "hedge" request goes out once a call outlives the recent p95
+# latency, and the first answer wins. A circuit breaker fails fast while the
+# provider keeps failing; callers catch LLMUnavailable and degrade.
+class LLMUnavailable(Exception):
+    """The provider failed, timed out, or the circuit breaker is open"""
+
+class CircuitBreaker:
+    """closed -> open after LLM_BREAKER_FAILURES straight failures; one probe call is let through per cooldown"""
+
+    def __init__(self, failure_threshold=None, cooldown_seconds=None):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= (self.cooldown_seconds or LLM_BREAKER_COOLDOWN_SECONDS):
+                self.state = 'half_open'
+                self.probing = False
+            if self.state == 'half_open':
+                if self.probing:
+                    return False
+                self.probing = True
+            return self.state != 'open'
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= (self.failure_threshold or LLM_BREAKER_FAILURES):
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+class LatencyTracker:
+    """Recent successful call latencies for one kind of call"""
+
+    def __init__(self, window=200, min_samples=20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+class ResponseCache:
+    """Bounded LRU of recent answers, keyed by call purpose and normalised prompt"""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(purpose, prompt):
+        return purpose, ' '.join(prompt.lower().split())
+
+    def get(self, purpose, prompt):
+        key = self.key(purpose, prompt)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        return None
+
+    def put(self, purpose, prompt, answer):
+        with self.lock:
+            self.entries[self.key(purpose, prompt)] = answer
+            self.entries.move_to_end(self.key(purpose, prompt))
+            while len(self.entries) > LLM_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+llm_breaker = CircuitBreaker()
+llm_cache = ResponseCache()
+llm_latency = {}
+llm_stats = {'calls': 0, 'hedges': 0, 'hedge_wins': 0, 'failures': 0, 'rejected': 0}
+_llm_executor = None
+_llm_lock = threading.Lock()
+
+def _llm_pool():
+    global _llm_executor
+    with _llm_lock:
+        if _llm_executor is None:
+            _llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix='brainyac-llm')
+        return _llm_executor
+
+def _call_llm(messages, params):
+    response = get_openai().ChatCompletion.create(messages=messages, request_timeout=LLM_TIMEOUT_SECONDS, **params)
+    return response.choices[0].message.content, getattr(response, 'usage', None)
+
+def llm_chat(purpose, messages, user_id=None, **params):
+    """Run a ChatCompletion with hedging, a deadline and the circuit breaker; returns the reply text.
+
+    purpose groups calls with similar latency (e.g. 'dobby', 'flashcards') for the hedge deadline
+    and for usage accounting; user_id is who the tokens are billed to.
+    Raises LLMUnavailable when no attempt succeeds in time or the breaker is open.
+    """
+    if not llm_breaker.allow():
+        llm_stats['rejected'] += 1
+        raise LLMUnavailable('The AI provider is unavailable; failing fast while it recovers')
+    llm_stats['calls'] += 1
+    tracker = llm_latency.setdefault(purpose, LatencyTracker())
+    pool = _llm_pool()
+    started = time.monotonic()
+    deadline = started + LLM_TIMEOUT_SECONDS
+    # Only hedge while healthy; a half-open probe should be a single request
+    hedge_at = started + (tracker.percentile(95) or LLM_HEDGE_AFTER_SECONDS) if llm_breaker.state == 'closed' else None
+
+    def attempt():
+        future = pool.submit(_call_llm, messages, params)
+        # Losing hedges still cost tokens, so every attempt is accounted for when it finishes
+        future.add_done_callback(lambda f: ai_usage.record(user_id, purpose, None if f.exception() else f.result()[1]))
+        return future
+
+    pending = {attempt(): 'primary'}
+    error = None
+
+    while pending:
+        now = time.monotonic()
+        wake_at = min(deadline, hedge_at) if hedge_at else deadline
+        done, _ = wait(list(pending), timeout=max(wake_at - now, 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            kind = pending.pop(future)
+            try:
+                content, _ = future.result()
+            except Exception as e:
+                error = e
+                continue
+            tracker.add(time.monotonic() - started)
+            llm_breaker.record_success()
+            if kind == 'hedge':
+                llm_stats['hedge_wins'] += 1
+            return content
+        if time.monotonic() >= deadline:
+            error = error or TimeoutError(f'no reply within {LLM_TIMEOUT_SECONDS}s')
+            break
+        # Hedge once: when the primary is slower than p95, or straight away if it failed
+        if hedge_at and (time.monotonic() >= hedge_at or not pending):
+            hedge_at = None
+            llm_stats['hedges'] += 1
+            pending[attempt()] = 'hedge'
+
+    llm_stats['failures'] += 1
+    llm_breaker.record_failure()
+    print(f"LLM call '{purpose}' failed: {error}")
+    raise LLMUnavailable(str(error))
+
+def llm_stream(purpose, messages, user_id=None, **params):
+    """Stream a ChatCompletion, yielding text as it arrives (the call's arguments when a function is forced).
+
+    Shares llm_chat()'s circuit breaker and deadline but is never hedged: the first
+    chunk arrives quickly, and a duplicate stream would bill every token twice.
+    Streamed replies carry no usage, so tokens are estimated. Raises LLMUnavailable.
+    """
+    if not llm_breaker.allow():
+        llm_stats['rejected'] += 1
+        raise LLMUnavailable('The AI provider is unavailable; failing fast while it recovers')
+    llm_stats['calls'] += 1
+    started = time.monotonic()
+    received = []
+    try:
+        chunks = get_openai().ChatCompletion.create(messages=messages, stream=True, request_timeout=LLM_TIMEOUT_SECONDS, **params)
+        for chunk in chunks:
+            if time.monotonic() - started > LLM_TIMEOUT_SECONDS:
+                raise TimeoutError(f'reply not finished within {LLM_TIMEOUT_SECONDS}s')
+            delta = chunk.choices[0].delta if chunk.choices else {}
+            piece = delta.get('content') or (delta.get('function_call') or {}).get('arguments') or ''
+            if piece:
+                received.append(piece)
+                yield piece
+    except GeneratorExit:
+        # The caller stopped reading early; the provider itself was answering fine
+        llm_breaker.record_success()
+        raise
+    except Exception as e:
+        llm_stats['failures'] += 1
+        llm_breaker.record_failure()
+        print(f"LLM stream '{purpose}' failed: {e}")
+        raise LLMUnavailable(str(e))
+    else:
+        llm_latency.setdefault(purpose, LatencyTracker()).add(time.monotonic() - started)
+        llm_breaker.record_success()
+    finally:
+        ai_usage.record(user_id, purpose, {
+            'prompt_tokens': sum(estimate_tokens(m.get('content')) for m in messages),
+            'completion_tokens': estimate_tokens(''.join(received)) if received else 0})
+
+@bp.route('/api/llm/health', methods=['GET'])
+def get_llm_health():
+    """Breaker state, call counters and per-purpose latency percentiles"""
+    if 'user_id' not in session or session.get('user_role') not in ['teacher', 'admin']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    return jsonify({
+        'success': True,
+        'breaker': llm_breaker.state,
+        'stats': llm_stats,
+        'latency': {purpose: {'p50': tracker.percentile(50), 'p95': tracker.percentile(95)}
+                    for purpose, tracker in llm_latency.items()}
+    })
+
+
+# ============================================================================
+# AI QUOTAS & USAGE ACCOUNTING
+# ============================================================================
+AI_REQUEST_COSTS = {'dobby': 1, 'doubtbot': 1, 'flashcards': 3}  # Bucket tokens each AI endpoint spends
+ROLE_QUOTA_CACHE_SECONDS = 30
+
+class UsageAccumulator:
+    """Per-process token counters, upserted into ai_usage every AI_USAGE_FLUSH_SECONDS"""
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+    def record(self, user_id, purpose, usage):
+        key = (user_id or 0, datetime.utcnow().date(), purpose)
+        with self.lock:
+            row = self.pending.setdefault(key, [0, 0, 0])
+            row[0] += 1
+            if usage:
+                row[1] += usage.get('prompt_tokens', 0)
+                row[2] += usage.get('completion_tokens', 0)
+            due = time.monotonic() - self.last_flush >= AI_USAGE_FLUSH_SECONDS
+            if due:
+                self.last_flush = time.monotonic()
+        if due:
+            _llm_pool().submit(self.flush)
+
+    def flush(self):
+        """Write the pending counters in one statement; returns the rows written"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending or engine is None:
+            return 0
+        rows = [{'user_id': user_id, 'day': day, 'purpose': purpose, 'requests': requests,
+                 'prompt_tokens': prompt, 'completion_tokens': completion}
+                for (user_id, day, purpose), (requests, prompt, completion) in pending.items()]
+        upsert = sqlite_insert(AIUsage)
+        try:
+            with engine.begin() as conn:
+                conn.execute(upsert.on_conflict_do_update(
+                    index_elements=['user_id', 'day', 'purpose'],
+                    set_={'requests': AIUsage.requests + upsert.excluded.requests,
+                          'prompt_tokens': AIUsage.prompt_tokens + upsert.excluded.prompt_tokens,
+                          'completion_tokens': AIUsage.completion_tokens + upsert.excluded.completion_tokens}
+                ), rows)
+        except Exception as e:
+            print(f"Error flushing AI usage: {e}")
+            # Keep the counts for the next flush rather than losing them
+            with self.lock:
+                for key, counts in pending.items():
+                    row = self.pending.setdefault(key, [0, 0, 0])
+                    for i, value in enumerate(counts):
+                        row[i] += value
+            return 0
+        return len(rows)
+
+ai_usage = UsageAccumulator()
+atexit.register(ai_usage.flush)
+_role_quotas = {'loaded_at': 0.0, 'quotas': {}}
+
+class QuotaExceeded(Exception):
+    def __init__(self, scope, retry_after):
+        super().__init__(scope)
+        self.scope = scope
+        self.retry_after = retry_after
+
+def role_quota(role):
+    """(capacity, refill_per_minute) for a role's per-user bucket, re-read from role_quotas every 30s"""
+    if time.monotonic() - _role_quotas['loaded_at'] > ROLE_QUOTA_CACHE_SECONDS:
+        db = SessionLocal()
+        try:
+            _role_quotas['quotas'] = {q.role: (q.capacity, q.refill_per_minute) for q in db.query(RoleQuota)}
+            _role_quotas['loaded_at'] = time.monotonic()
+        finally:
+            db.close()
+    return _role_quotas['quotas'].get(role, (AI_USER_BUCKET_CAPACITY, AI_USER_REFILL_PER_MINUTE))
+
+def take_bucket_tokens(conn, key, cost, capacity, refill_per_minute, now):
+    """Refill a bucket for the time elapsed and debit cost in one statement.
+
+    Raises QuotaExceeded (with the seconds until cost is available) and leaves
+    the bucket untouched when it can't cover cost.
+    """
+    per_second = refill_per_minute / 60
+    refilled = func.min(capacity, RateBucket.tokens + (now - RateBucket.updated_at) * per_second)
+    upsert = sqlite_insert(RateBucket).values(key=key, tokens=capacity - cost, updated_at=now)
+    taken = conn.execute(upsert.on_conflict_do_update(
+        index_elements=['key'], set_={'tokens': refilled - cost, 'updated_at': now}, where=refilled >= cost
+    ).returning(RateBucket.tokens)).first()
+    if taken is None:
+        available = conn.execute(select(refilled).where(RateBucket.key == key)).scalar() or 0
+        raise QuotaExceeded(key, (cost - available) / per_second if per_second else 3600)
+
+def enforce_ai_quota(kind):
+    """Spend the signed-in user's and the global bucket tokens for an AI request.
+
+    Call before any upstream work; returns a 429 response to send back when
+    either bucket is empty, otherwise None.
+    """
+    capacity, refill_per_minute = role_quota(session.get('user_role'))
+    now = time.time()
+    try:
+        # One transaction, so a global refusal also gives the user's tokens back
+        with engine.begin() as conn:
+            take_bucket_tokens(conn, f"user:{session['user_id']}", AI_REQUEST_COSTS[kind], capacity, refill_per_minute, now)
+            take_bucket_tokens(conn, 'global', AI_REQUEST_COSTS[kind], AI_GLOBAL_BUCKET_CAPACITY, AI_GLOBAL_REFILL_PER_MINUTE, now)
+    except QuotaExceeded as e:
+        retry_after = max(int(math.ceil(e.retry_after)), 1)
+        message = ('You are sending AI requests too quickly.' if e.scope != 'global'
+                   else 'The AI assistant is very busy right now.')
+        response = jsonify({'success': False, 'error': f'{message} Please try again in {retry_after} seconds.',
+                            'retry_after': retry_after})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+    return None
+
+@bp.route('/api/admin/quotas', methods=['GET', 'PUT'])
+def manage_role_quotas():
+    """Per-role AI request quotas; teachers and admins may change them"""
+    if 'user_id' not in session or session.get('user_role') not in ['teacher', 'admin']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    if request.method == 'PUT':
+        data = request.get_json()
+        role = data.get('role')
+        try:
+            capacity = float(data.get('capacity'))
+            refill_per_minute = float(data.get('refill_per_minute'))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'capacity and refill_per_minute must be numbers'}), 400
+        if role not in ['student', 'teacher', 'admin']:
+            return jsonify({'success': False, 'error': 'Unknown role'}), 400
+        if capacity < max(AI_REQUEST_COSTS.values()) or refill_per_minute <= 0:
+            return jsonify({'success': False, 'error': f'capacity must be at least {max(AI_REQUEST_COSTS.values())} and refill positive'}), 400
+        
+        db = SessionLocal()
+        try:
+            upsert = sqlite_insert(RoleQuota).values(role=role, capacity=capacity, refill_per_minute=refill_per_minute,
+                                                     updated_by=session['user_id'], updated_at=datetime.utcnow())
+            db.execute(upsert.on_conflict_do_update(index_elements=['role'], set_={
+                'capacity': upsert.excluded.capacity, 'refill_per_minute': upsert.excluded.refill_per_minute,
+                'updated_by': upsert.excluded.updated_by, 'updated_at': upsert.excluded.updated_at}))
+            db.commit()
+        finally:
+            db.close()
+        _role_quotas['loaded_at'] = 0.0
+    
+    return jsonify({
+        'success': True,
+        'quotas': {role: dict(zip(['capacity', 'refill_per_minute'], role_quota(role)))
+                   for role in ['student', 'teacher', 'admin']},
+        'global': {'capacity': AI_GLOBAL_BUCKET_CAPACITY, 'refill_per_minute': AI_GLOBAL_REFILL_PER_MINUTE},
+        'costs': AI_REQUEST_COSTS
+    })
+
+@bp.route('/api/admin/usage', methods=['GET'])
+def get_ai_usage():
+    """Token usage per user over the last ?days= days (default 7), heaviest users first"""
+    if 'user_id' not in session or session.get('user_role') not in ['teacher', 'admin']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    ai_usage.flush()
+    try:
+        days = min(max(int(request.args.get('days', 7)), 1), 366)
+    except ValueError:
+        days = 7
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    
+    db = SessionLocal()
+    try:
+        total_tokens = func.sum(AIUsage.prompt_tokens + AIUsage.completion_tokens)
+        users = db.query(AIUsage.user_id, Profile.name, Profile.role, func.sum(AIUsage.requests),
+                         func.sum(AIUsage.prompt_tokens), func.sum(AIUsage.completion_tokens)) \
+            .outerjoin(Profile, Profile.id == AIUsage.user_id) \
+            .filter(AIUsage.day >= since).group_by(AIUsage.user_id) \
+            .order_by(total_tokens.desc()).limit(50).all()
+        by_purpose = db.query(AIUsage.purpose, func.sum(AIUsage.requests), func.sum(AIUsage.prompt_tokens),
+                              func.sum(AIUsage.completion_tokens)) \
+            .filter(AIUsage.day >= since).group_by(AIUsage.purpose).all()
+        return jsonify({
+            'success': True,
+            'since': since.isoformat(),
+            'users': [{'user_id': user_id, 'name': name or 'System', 'role': role, 'requests': requests,
+                       'prompt_tokens': prompt, 'completion_tokens': completion}
+                      for user_id, name, role, requests, prompt, completion in users],
+            'by_purpose': {purpose: {'requests': requests, 'prompt_tokens': prompt, 'completion_tokens': completion}
+                           for purpose, requests, prompt, completion in by_purpose}
+        })
+    finally:
+        db.close()
+
+
 # ============================================================================
 # TEMPLATE RENDERING ROUTES
 # ============================================================================
-@app.route('/')
+@bp.route('/')
 def home():
     return render_template('index.html')
 
-@app.route('/auth')
+@bp.route('/auth')
 def auth():
     return render_template('auth.html')
 
-@app.route('/demo')
+@bp.route('/demo')
 def demo():
     return render_template('demo.html')
 
-@app.route('/profile')
+@bp.route('/profile')
 def profile():
     if 'user_id' not in session:
-        return redirect(url_for('auth'))
+        return redirect(url_for('main.auth'))
     return render_template('profile.html')
 
-@app.route('/student-dashboard')
+@bp.route('/student-dashboard')
 def student_dashboard():
     # A simple check to redirect if not logged in
     if 'user_id' not in session:
-        return redirect(url_for('auth'))
+        return redirect(url_for('main.auth'))
     return render_template('student-dashboard.html')
 
-@app.route('/teacher-dashboard')
+@bp.route('/teacher-dashboard')
 def teacher_dashboard():
     # A simple check to redirect if not logged in
     if 'user_id' not in session:
-        return redirect(url_for('auth'))
+        return redirect(url_for('main.auth'))
     if session.get('user_role') != 'teacher':
-        return redirect(url_for('student_dashboard'))
+        return redirect(url_for('main.student_dashboard'))
     return render_template('teacher-dashboard.html')
 
-@app.route('/dobby')
+@bp.route('/dobby')
 def dobby():
     # A simple check to redirect if not logged in
     if 'user_id' not in session:
-        return redirect(url_for('auth'))
+        return redirect(url_for('main.auth'))
     return render_template('dobby.html')
 
-@app.route('/qna-quiz')
+@bp.route('/qna-quiz')
 def qna_quiz():
     # A simple check to redirect if not logged in
     if 'user_id' not in session:
-        return redirect(url_for('auth'))
+        return redirect(url_for('main.auth'))
     return render_template('qna-quiz.html')
 
-@app.route('/api/dobby/chat', methods=['POST'])
+# ============================================================================
+# DOBBY CONVERSATION MEMORY
+# ============================================================================
+DOBBY_SYSTEM_PROMPT = """You are Dobby, a friendly and knowledgeable AI educational assistant. Your role is to:
+        1. Help students understand complex concepts clearly
+        2. Provide step-by-step explanations
+        3. Give examples when helpful
+        4. Be encouraging and supportive
+        5. Ask clarifying questions if needed
+        6. Use simple language appropriate for students
+        
+        Always be helpful, patient, and educational in your responses."""
+
+def estimate_tokens(text):
+    """Cheap token estimate (roughly 4 characters per token for English text)"""
+    return len(text or '') // 4 + 1
+
+def build_dobby_context(db, thread, user_message):
+    """Build the prompt for a thread: system prompt, running summary, recent turns and the new message.
+
+    Only the last DOBBY_HISTORY_TURNS turns are loaded, and the oldest of those are
+    dropped until the prompt fits DOBBY_PROMPT_TOKEN_BUDGET, so prompt size stays
+    bounded however long the thread gets. thread is None for a new conversation.
+    """
+    window = []
+    if thread:
+        window = db.query(ChatMessage).filter(ChatMessage.thread_id == thread.id)\
+            .order_by(ChatMessage.id.desc()).limit(DOBBY_HISTORY_TURNS * 2).all()
+
+    messages = [{"role": "system", "content": DOBBY_SYSTEM_PROMPT}]
+    used = estimate_tokens(DOBBY_SYSTEM_PROMPT) + estimate_tokens(user_message)
+    if thread and thread.summary:
+        summary = f"Summary of the earlier conversation with this student: {thread.summary}"
+        messages.append({"role": "system", "content": summary})
+        used += estimate_tokens(summary)
+
+    # window is newest first, so stop at the first turn that no longer fits
+    kept = []
+    for message in window:
+        if used + (message.token_count or 0) > DOBBY_PROMPT_TOKEN_BUDGET:
+            break
+        kept.append(message)
+        used += message.token_count or 0
+
+    messages.extend({"role": m.role, "content": m.content} for m in reversed(kept))
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+@job_handler('summarize_thread')
+def summarize_thread(thread_id):
+    """Fold turns that fell out of the verbatim window into the thread's running summary"""
+    db = SessionLocal()
+    try:
+        thread = db.query(ChatThread).filter(ChatThread.id == thread_id).first()
+        if not thread:
+            return
+
+        # Oldest message still inside the verbatim window
+        window_start = db.query(ChatMessage.id).filter(ChatMessage.thread_id == thread_id)\
+            .order_by(ChatMessage.id.desc()).offset(DOBBY_HISTORY_TURNS * 2 - 1).limit(1).scalar()
+        if window_start is None:
+            return
+
+        pending = db.query(ChatMessage).filter(
+            ChatMessage.thread_id == thread_id,
+            ChatMessage.id > (thread.summarized_through_id or 0),
+            ChatMessage.id < window_start
+        ).order_by(ChatMessage.id).limit(DOBBY_SUMMARY_BATCH * 5).all()
+        if len(pending) < DOBBY_SUMMARY_BATCH:
+            return
+
+        transcript = "\n".join(f"{m.role}: {m.content}" for m in pending)
+        prompt = f"""Update the summary of a tutoring conversation between a student and Dobby.
+        Keep the topics covered, what the student struggled with and anything they asked to remember.
+        Reply with the updated summary only, in under {DOBBY_SUMMARY_MAX_TOKENS} tokens.
+
+        Current summary:
+        {thread.summary or '(none)'}
+
+        New messages:
+        {transcript}
+        """
+        # LLMUnavailable fails the job, which the queue retries with backoff
+        summary = llm_chat('summary', [{"role": "user", "content": prompt}], user_id=thread.user_id,
+                           model="gpt-3.5-turbo", max_tokens=DOBBY_SUMMARY_MAX_TOKENS, temperature=0.3)
+        thread.summary = summary.strip()
+        thread.summarized_through_id = pending[-1].id
+        db.commit()
+    finally:
+        db.close()
+
+@bp.route('/api/dobby/chat', methods=['POST'])
 def dobby_chat():
     try:
         if 'user_id' not in session:
@@ -268,44 +1360,65 @@ def dobby_chat():
         
         data = request.get_json()
         user_message = data.get('message', '').strip()
+        thread_id = data.get('thread_id')
         
         if not user_message:
             return jsonify({'success': False, 'error': 'Message is required'}), 400
         
-        # Create a context-aware prompt for educational assistance
-        system_prompt = """You are Dobby, a friendly and knowledgeable AI educational assistant. Your role is to:
-        1. Help students understand complex concepts clearly
-        2. Provide step-by-step explanations
-        3. Give examples when helpful
-        4. Be encouraging and supportive
-        5. Ask clarifying questions if needed
-        6. Use simple language appropriate for students
-        
-        Always be helpful, patient, and educational in your responses."""
-        
-        # Create the conversation for OpenAI
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ]
-        
-        # Call OpenAI API
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            max_tokens=500,
-            temperature=0.7
-        )
-        
-        ai_response = response.choices[0].message.content.strip()
+        user_id = session['user_id']
+        db = SessionLocal()
+        try:
+            thread = None
+            if thread_id:
+                thread = db.query(ChatThread).filter(ChatThread.id == thread_id, ChatThread.user_id == user_id).first()
+                if not thread:
+                    return jsonify({'success': False, 'error': 'Conversation not found'}), 404
+
+            # Create the conversation for OpenAI. Nothing is written until the reply is back,
+            # so the model call never holds the SQLite write lock.
+            messages = build_dobby_context(db, thread, user_message)
+            
+            limited = enforce_ai_quota('dobby')
+            if limited:
+                return limited
+            
+            # Call OpenAI API
+            try:
+                ai_response = llm_chat('dobby', messages, user_id=user_id, model="gpt-3.5-turbo", max_tokens=500, temperature=0.7).strip()
+            except LLMUnavailable:
+                # Nothing is saved to the thread, so the student can simply ask again later
+                return jsonify({
+                    'success': True,
+                    'response': llm_cache.get('dobby', user_message) or DOBBY_UNAVAILABLE_REPLY,
+                    'thread_id': data.get('thread_id'),
+                    'points_earned': 0,
+                    'degraded': True
+                })
+            llm_cache.put('dobby', user_message, ai_response)
+
+            if thread is None:
+                thread = ChatThread(user_id=user_id, title=user_message[:60])
+                db.add(thread)
+                db.flush()
+            db.add(ChatMessage(thread_id=thread.id, role='user', content=user_message,
+                               token_count=estimate_tokens(user_message)))
+            db.add(ChatMessage(thread_id=thread.id, role='assistant', content=ai_response,
+                               token_count=estimate_tokens(ai_response)))
+            thread.updated_at = datetime.utcnow()
+            db.commit()
+            thread_id = thread.id
+        finally:
+            db.close()
+
+        enqueue_job('summarize_thread', {'thread_id': thread_id}, dedup_key=f'summarize_thread:{thread_id}')
         
         # Award points for using Dobby (educational activity)
-        user_id = session['user_id']
-        award_points(user_id, 2, "Used Dobby AI Assistant")
+        enqueue_job('award_points', {'user_id': user_id, 'points': 2, 'reason': "Used Dobby AI Assistant"}, priority=10)
         
         return jsonify({
             'success': True,
             'response': ai_response,
+            'thread_id': thread_id,
             'points_earned': 2
         })
         
@@ -318,16 +1431,119 @@ def dobby_chat():
             'success': False, 
             'error': f'Error: {str(e)}'
         }), 500
+
+@bp.route('/api/dobby/threads', methods=['GET'])
+def list_dobby_threads():
+    """List the current user's Dobby conversations, most recent first"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    db = SessionLocal()
+    try:
+        threads = db.query(ChatThread).filter(ChatThread.user_id == session['user_id'])\
+            .order_by(ChatThread.updated_at.desc()).limit(50).all()
+        return jsonify({'success': True, 'threads': [{
+            'id': t.id,
+            'title': t.title,
+            'updated_at': t.updated_at.isoformat()
+        } for t in threads]})
+    finally:
+        db.close()
+
+@bp.route('/api/dobby/threads/<int:thread_id>', methods=['GET'])
+def get_dobby_thread(thread_id):
+    """Return the most recent messages of one of the user's Dobby conversations"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    db = SessionLocal()
+    try:
+        thread = db.query(ChatThread).filter(ChatThread.id == thread_id, ChatThread.user_id == session['user_id']).first()
+        if not thread:
+            return jsonify({'success': False, 'error': 'Conversation not found'}), 404
+        
+        messages = db.query(ChatMessage).filter(ChatMessage.thread_id == thread_id)\
+            .order_by(ChatMessage.id.desc()).limit(limit).all()
+        return jsonify({
+            'success': True,
+            'thread': {'id': thread.id, 'title': thread.title},
+            'messages': [{
+                'role': m.role,
+                'content': m.content,
+                'created_at': m.created_at.isoformat()
+            } for m in reversed(messages)]
+        })
+    finally:
+        db.close()
     
-    # Add these two routes in app.py
+# ============================================================================
+# REWARD CODE POOL
+# ============================================================================
+REWARD_CODE_ALPHABET = string.ascii_uppercase + string.digits
+
+def mint_reward_code():
+    return ''.join(secrets.choice(REWARD_CODE_ALPHABET) for _ in range(12))
+
+@job_handler('refill_reward_pool')
+def refill_reward_pool(reward_type, target=None):
+    """Top a reward type's pool back up to target codes with bulk inserts; returns codes added"""
+    target = target or REWARD_POOL_TARGET
+    db = SessionLocal()
+    added = 0
+    try:
+        available = db.query(func.count(RewardCodePool.id)).filter(RewardCodePool.reward_type == reward_type).scalar()
+        while available + added < target:
+            candidates = {mint_reward_code() for _ in range(min(target - available - added, 1000))}
+            # Codes already handed out leave the pool, so check issued codes explicitly
+            issued = {c for (c,) in db.query(RewardCode.code).filter(RewardCode.code.in_(candidates))}
+            rows = [{'reward_type': reward_type, 'code': c, 'created_at': datetime.utcnow()} for c in candidates - issued]
+            result = db.connection().execute(sqlite_insert(RewardCodePool).on_conflict_do_nothing(), rows)
+            added += result.rowcount
+            db.commit()
+        return added
+    finally:
+        db.close()
+
+def schedule_pool_refill(reward_type):
+    """Queue a bulk refill for a pool unless one is already pending"""
+    enqueue_job('refill_reward_pool', {'reward_type': reward_type}, priority=5,
+                dedup_key=f'refill_reward_pool:{reward_type}')
+
+def take_pooled_code(db, reward_type):
+    """Remove and return one pre-minted code in a single statement, or None if the pool is empty"""
+    return db.execute(text(
+        "DELETE FROM reward_code_pool WHERE id = ("
+        "SELECT id FROM reward_code_pool WHERE reward_type = :reward_type ORDER BY id LIMIT 1"
+        ") RETURNING code"
+    ), {'reward_type': reward_type}).scalar()
+
+def reward_pool_inventory(db):
+    counts = dict(db.query(RewardCodePool.reward_type, func.count(RewardCodePool.id))
+                  .group_by(RewardCodePool.reward_type).all())
+    return {reward_type: counts.get(reward_type, 0) for reward_type in REWARD_TYPES}
+
+def find_redemption(db, user_id, idempotency_key):
+    """The reward code already issued for this user and idempotency key, if any"""
+    return db.query(RewardCode).join(RedemptionRequest, RedemptionRequest.reward_code_id == RewardCode.id)\
+        .filter(RedemptionRequest.user_id == user_id, RedemptionRequest.idempotency_key == idempotency_key).first()
+
+def redemption_response(user, reward_code, replayed=False):
+    return jsonify({
+        'success': True, 
+        'message': 'Points redeemed successfully!',
+        'new_points_total': user.points,
+        'reward_code': reward_code.code,
+        'replayed': replayed
+    })
 
-@app.route('/redeem')
+@bp.route('/redeem')
 def redeem():
     if 'user_id' not in session:
-        return redirect(url_for('auth'))
+        return redirect(url_for('main.auth'))
     return render_template('redeem.html')
 
-@app.route('/api/redeem-points', methods=['POST'])
+@bp.route('/api/redeem-points', methods=['POST'])
 def redeem_points():
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
@@ -336,6 +1552,9 @@ def redeem_points():
     reward_type = data.get('reward_type')
     if not reward_type:
         return jsonify({'success': False, 'error': 'Reward type is required'}), 400
+    if reward_type not in REWARD_TYPES:
+        return jsonify({'success': False, 'error': 'Unknown reward type'}), 400
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
 
     db = SessionLocal()
     try:
@@ -343,34 +1562,49 @@ def redeem_points():
         if not user:
             return jsonify({'success': False, 'error': 'User not found'}), 404
 
-        if user.points < 50:
+        # A retried request gets back the code it was already given
+        if idempotency_key:
+            previous = find_redemption(db, user.id, idempotency_key)
+            if previous:
+                return redemption_response(user, previous, replayed=True)
+
+        # Deduct points only if the balance still covers it at write time
+        deducted = db.query(Profile).filter(Profile.id == user.id, Profile.points >= REWARD_POINTS_COST)\
+            .update({Profile.points: Profile.points - REWARD_POINTS_COST}, synchronize_session=False)
+        if not deducted:
             return jsonify({'success': False, 'error': 'Not enough points to redeem.'}), 403
 
-        # Deduct points
-        user.points -= 50
-        
-        # Generate a unique random code
-        while True:
-            code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=12))
-            if not db.query(RewardCode).filter_by(code=code).first():
-                break # Code is unique
+        code = take_pooled_code(db, reward_type)
+        if code is None:
+            # Pool ran dry before the background refill caught up
+            code = mint_reward_code()
 
         # Save the new reward code
         new_code = RewardCode(
             user_id=user.id,
             code=code,
             reward_type=reward_type,
-            points_spent=50
+            points_spent=REWARD_POINTS_COST
         )
         db.add(new_code)
+        db.flush()
+        if idempotency_key:
+            db.add(RedemptionRequest(user_id=user.id, idempotency_key=idempotency_key, reward_code_id=new_code.id))
+        db.refresh(user)
+        track_leaderboard_change(db, user)
         db.commit()
 
-        return jsonify({
-            'success': True, 
-            'message': 'Points redeemed successfully!',
-            'new_points_total': user.points,
-            'reward_code': code
-        })
+        response = redemption_response(user, new_code)
+        pool_low = reward_pool_inventory(db)[reward_type] < REWARD_POOL_LOW_WATER
+    except IntegrityError:
+        db.rollback()
+        # A concurrent request with the same key won the race; answer with its code
+        previous = find_redemption(db, session['user_id'], idempotency_key) if idempotency_key else None
+        if not previous:
+            print("Error redeeming points: reward code collision")
+            return jsonify({'success': False, 'error': 'An internal error occurred.'}), 500
+        user = db.query(Profile).filter(Profile.id == session['user_id']).first()
+        return redemption_response(user, previous, replayed=True)
     except Exception as e:
         db.rollback()
         print(f"Error redeeming points: {e}")
@@ -378,10 +1612,42 @@ def redeem_points():
     finally:
         db.close()
 
+    if pool_low:
+        schedule_pool_refill(reward_type)
+    return response
+
+@bp.route('/api/rewards/inventory', methods=['GET'])
+def get_reward_inventory():
+    """Pre-minted codes left per reward type, for monitoring pool depletion"""
+    if 'user_id' not in session or session.get('user_role') not in ['teacher', 'admin']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    db = SessionLocal()
+    try:
+        inventory = reward_pool_inventory(db)
+        issued = dict(db.query(RewardCode.reward_type, func.count(RewardCode.id)).group_by(RewardCode.reward_type).all())
+    finally:
+        db.close()
+
+    for reward_type, available in inventory.items():
+        if available < REWARD_POOL_LOW_WATER:
+            schedule_pool_refill(reward_type)
+    return jsonify({
+        'success': True,
+        'target': REWARD_POOL_TARGET,
+        'low_water': REWARD_POOL_LOW_WATER,
+        'inventory': [{
+            'reward_type': reward_type,
+            'available': available,
+            'issued': issued.get(reward_type, 0),
+            'low': available < REWARD_POOL_LOW_WATER
+        } for reward_type, available in inventory.items()]
+    })
+
 # ============================================================================
 # AUTHENTICATION API
 # ============================================================================
-@app.route('/api/signup', methods=['POST'])
+@bp.route('/api/signup', methods=['POST'])
 def signup():
     data = request.get_json()
     db = SessionLocal()
@@ -407,7 +1673,7 @@ def signup():
         db.close()
 
 
-@app.route('/api/signin', methods=['POST'])
+@bp.route('/api/signin', methods=['POST'])
 def signin():
     data = request.get_json()
     db = SessionLocal()
@@ -422,12 +1688,12 @@ def signin():
     finally:
         db.close()
 
-@app.route('/api/logout')
+@bp.route('/api/logout')
 def logout():
     session.clear()
     return jsonify({'success': True})
 
-@app.route('/api/user/profile')
+@bp.route('/api/user/profile')
 def get_profile():
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
@@ -448,7 +1714,7 @@ def get_profile():
 # STUDENT DASHBOARD API ENDPOINTS
 # ============================================================================
 
-@app.route('/api/learning-topics', methods=['GET', 'POST'])
+@bp.route('/api/learning-topics', methods=['GET', 'POST'])
 def learning_topics():
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
@@ -468,7 +1734,31 @@ def learning_topics():
     finally:
         db.close()
 
-@app.route('/api/doubts', methods=['GET', 'POST'])
+def list_student_doubts(db, student_id):
+    """A student's doubts, newest first, then their archived ones"""
+    doubts = db.query(Doubt).filter(Doubt.student_id == student_id).order_by(Doubt.created_at.desc()).all()
+    # Long-resolved doubts live in the archive; history views still list them
+    archived = db.query(ArchivedDoubt).filter(ArchivedDoubt.student_id == student_id) \
+        .order_by(ArchivedDoubt.created_at.desc()).all()
+    return doubts + archived
+
+def doubt_content_hash(topic, question, image_bytes=None):
+    """Identity of a submission: normalised topic and question plus the attached image's bytes"""
+    digest = hashlib.sha256(doubt_question_hash(topic, question).encode())
+    if image_bytes:
+        digest.update(image_bytes)
+    return digest.hexdigest()
+
+def find_submitted_doubt(db, student_id, idempotency_key, content_hash):
+    """The doubt an earlier submit already created: same idempotency key, or the same content still pending"""
+    if idempotency_key:
+        doubt = db.query(Doubt).filter(Doubt.student_id == student_id, Doubt.idempotency_key == idempotency_key).first()
+        if doubt:
+            return doubt
+    return db.query(Doubt).filter(Doubt.student_id == student_id, Doubt.status == 'pending',
+                                  Doubt.content_hash == content_hash).first()
+
+@bp.route('/api/doubts', methods=['GET', 'POST'])
 def handle_doubts():
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
@@ -476,7 +1766,7 @@ def handle_doubts():
     db = SessionLocal()
     try:
         if request.method == 'GET':
-            doubts = db.query(Doubt).filter(Doubt.student_id == session['user_id']).all()
+            doubts = list_student_doubts(db, session['user_id'])
             return jsonify({'success': True, 'doubts': [{
                 'id': d.id,
                 'topic': d.topic, 
@@ -494,17 +1784,30 @@ def handle_doubts():
                 'final_rating': d.final_rating,
                 'final_upvoted': d.final_upvoted,
                 'points_awarded': d.points_awarded,
-                'created_at': d.created_at.isoformat()
+                'created_at': d.created_at.isoformat(),
+                'archived': isinstance(d, ArchivedDoubt)
             } for d in doubts]})
 
         if request.method == 'POST':
             topic = request.form.get('topic', '').strip()
             question = request.form.get('question', '').strip()
             question_image = request.files.get('question_image')
+            idempotency_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
             
             if not topic or not question:
                 return jsonify({'success': False, 'error': 'Topic and question are required'}), 400
             
+            image_bytes = None
+            if question_image:
+                image_bytes = question_image.stream.read()
+                question_image.stream.seek(0)
+            content_hash = doubt_content_hash(topic, question, image_bytes)
+            
+            # A retried or double-clicked submit gets back the doubt it already created
+            previous = find_submitted_doubt(db, session['user_id'], idempotency_key, content_hash)
+            if previous:
+                return jsonify({'success': True, 'message': 'Doubt submitted', 'doubt_id': previous.id, 'replayed': True})
+            
             question_image_filename = None
             if question_image:
                 question_image_filename = save_uploaded_file(question_image, 'questions')
@@ -513,20 +1816,32 @@ def handle_doubts():
                 student_id=session['user_id'], 
                 topic=topic, 
                 question=question,
-                question_image=question_image_filename
+                question_image=question_image_filename,
+                idempotency_key=idempotency_key,
+                content_hash=content_hash
             )
             
-            student = db.query(Profile).filter(Profile.id == session['user_id']).first()
-            if student:
-                student.doubts_asked = (student.doubts_asked or 0) + 1
-            
             db.add(new_doubt)
-            db.commit()
-            return jsonify({'success': True, 'message': 'Doubt submitted'})
+            try:
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+                # A concurrent copy of this submit won the race; answer with its doubt
+                previous = find_submitted_doubt(db, session['user_id'], idempotency_key, content_hash)
+                if not previous:
+                    raise
+                if question_image_filename and question_image_filename != previous.question_image:
+                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], 'questions', question_image_filename))
+                return jsonify({'success': True, 'message': 'Doubt submitted', 'doubt_id': previous.id, 'replayed': True})
+            route_new_doubt(new_doubt)
+            enqueue_job('increment_counter', {'user_id': session['user_id'], 'field': 'doubts_asked'}, priority=10)
+            # Drafted in the background; the student never waits on the model
+            enqueue_job('draft_doubt_answer', {'doubt_id': new_doubt.id}, max_attempts=4)
+            return jsonify({'success': True, 'message': 'Doubt submitted', 'doubt_id': new_doubt.id})
     finally:
         db.close()
 
-@app.route('/api/doubtbot/chat', methods=['POST'])
+@bp.route('/api/doubtbot/chat', methods=['POST'])
 def doubtbot_chat():
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
@@ -534,21 +1849,24 @@ def doubtbot_chat():
     data = request.get_json()
     user_message = data.get('message', '')
     
+    limited = enforce_ai_quota('doubtbot')
+    if limited:
+        return limited
+    
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are Dobby, a friendly and helpful AI learning assistant."},
-                {"role": "user", "content": user_message}
-            ]
-        )
-        ai_response = response.choices[0].message.content
+        ai_response = llm_chat('doubtbot', [
+            {"role": "system", "content": "You are Dobby, a friendly and helpful AI learning assistant."},
+            {"role": "user", "content": user_message}
+        ], user_id=session['user_id'], model="gpt-3.5-turbo")
+        llm_cache.put('doubtbot', user_message, ai_response)
         return jsonify({'success': True, 'response': ai_response})
-    except Exception as e:
-        print(f"OpenAI Error: {e}")
-        return jsonify({'success': False, 'error': 'AI assistant is currently unavailable.'}), 503
+    except LLMUnavailable:
+        cached = llm_cache.get('doubtbot', user_message)
+        if cached:
+            return jsonify({'success': True, 'response': cached, 'degraded': True})
+        return jsonify({'success': False, 'error': 'AI assistant is currently unavailable. You can submit this as a doubt for a teacher.'}), 503
 
-@app.route('/api/qna/start', methods=['POST'])
+@bp.route('/api/qna/start', methods=['POST'])
 def start_qna():
     try:
         if 'user_id' not in session:
@@ -556,34 +1874,46 @@ def start_qna():
         
         data = request.get_json()
         topic = data.get('topic', '').strip()
-        difficulty = data.get('difficulty', 'medium').strip().lower()
+        difficulty = data.get('difficulty', 'auto').strip().lower()
         
         if not topic:
             return jsonify({'success': False, 'error': 'Topic is required'}), 400
         
-        if difficulty not in ['easy', 'medium', 'hard']:
-            difficulty = 'medium'
-        
-        questions = generate_simple_questions(topic, difficulty)
-        
         db = SessionLocal()
         try:
+            mastery = get_topic_mastery(db, session['user_id'], flashcard_topic_key(topic))
+            if difficulty in QUIZ_DIFFICULTY_RATINGS:
+                target = QUIZ_DIFFICULTY_RATINGS[difficulty]
+            else:
+                # Aim for questions the student answers correctly about QUIZ_TARGET_SUCCESS of the time
+                target = mastery.rating - QUIZ_TARGET_OFFSET
+                difficulty = closest_difficulty(target)
+            items = pick_quiz_items(db, topic, target)
+            
+            qna_session = QnASession(student_id=session['user_id'], topic=topic, difficulty=difficulty,
+                                     item_ids=json.dumps([item.id for item in items]))
+            db.add(qna_session)
             student = db.query(Profile).filter(Profile.id == session['user_id']).first()
             if student:
                 student.qna_sessions = (student.qna_sessions or 0) + 1
-                db.commit()
+            db.commit()
+            
+            questions = []
+            for item in items:
+                question = json.loads(item.question)
+                # Answers are graded server-side against the stored session
+                questions.append({'question': question['question'], 'options': question['options']})
+            
+            return jsonify({
+                'success': True,
+                'questions': questions,
+                'session_id': qna_session.id,
+                'difficulty': difficulty,
+                'mastery': round(mastery.rating, 3)
+            })
         finally:
             db.close()
         
-        session_id = f"quiz_{int(time.time())}_{session['user_id']}"
-        
-        return jsonify({
-            'success': True,
-            'questions': questions,
-            'session_id': session_id,
-            'difficulty': difficulty
-        })
-        
     except Exception as e:
         print(f"Error starting QnA: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -631,7 +1961,7 @@ def generate_simple_questions(topic, difficulty):
             q['question'] = q['question'].replace('basic', 'advanced').replace('simple', 'complex')
     return base_questions
 
-@app.route('/api/qna/submit', methods=['POST'])
+@bp.route('/api/qna/submit', methods=['POST'])
 def submit_qna_answers():
     try:
         if 'user_id' not in session:
@@ -644,34 +1974,64 @@ def submit_qna_answers():
         if not session_id or not answers:
             return jsonify({'success': False, 'error': 'Session ID and answers are required'}), 400
         
-        topic = "General Topic"
-        difficulty = "medium"
-        questions = generate_simple_questions(topic, difficulty)
-        
-        correct_answers = 0
-        total_questions = len(questions)
-        results = []
-        points_earned = 0
-        
-        for i, question in enumerate(questions):
-            user_answer = answers.get(str(i), -1)
-            correct_answer = question.get('correct_answer', 0)
-            is_correct = user_answer == correct_answer
+        db = SessionLocal()
+        try:
+            qna_session = db.query(QnASession).filter(QnASession.id == session_id,
+                                                      QnASession.student_id == session['user_id']).first()
+            if not qna_session or not qna_session.item_ids:
+                return jsonify({'success': False, 'error': 'Quiz session not found'}), 404
             
-            if is_correct:
-                correct_answers += 1
-                points_earned += 10
+            # Claim the session so a resubmitted quiz can't be graded (and paid) twice
+            claimed = db.execute(
+                update(QnASession)
+                .where(QnASession.id == qna_session.id, QnASession.completed == False)
+                .values(completed=True)
+            ).rowcount
+            if not claimed:
+                return jsonify({'success': False, 'error': 'Quiz already submitted'}), 409
             
-            explanation = question.get('explanation', 'No explanation available')
+            item_ids = json.loads(qna_session.item_ids)
+            items = {item.id: item for item in db.query(QuizItem).filter(QuizItem.id.in_(item_ids))}
+            mastery = get_topic_mastery(db, session['user_id'], flashcard_topic_key(qna_session.topic))
             
-            results.append({
-                'question': question['question'],
-                'user_answer': user_answer,
-                'correct_answer': correct_answer,
-                'is_correct': is_correct,
-                'explanation': explanation,
-                'options': question['options']
-            })
+            correct_answers = 0
+            total_questions = len(item_ids)
+            results = []
+            points_earned = 0
+            
+            for i, item_id in enumerate(item_ids):
+                item = items[item_id]
+                question = json.loads(item.question)
+                user_answer = answers.get(str(i), -1)
+                correct_answer = question.get('correct_answer', 0)
+                is_correct = user_answer == correct_answer
+                
+                if is_correct:
+                    correct_answers += 1
+                    points_earned += QUIZ_POINTS[item.difficulty]
+                
+                update_mastery(db, mastery, item, is_correct)
+                db.add(QuizAnswer(session_id=qna_session.id, student_id=session['user_id'],
+                                  item_id=item.id, correct=is_correct))
+                
+                results.append({
+                    'question': question['question'],
+                    'user_answer': user_answer,
+                    'correct_answer': correct_answer,
+                    'is_correct': is_correct,
+                    'explanation': question.get('explanation', 'No explanation available'),
+                    'options': question['options']
+                })
+            
+            qna_session.correct_answers = correct_answers
+            qna_session.points_earned = points_earned
+            db.commit()
+            
+            topic = qna_session.topic
+            difficulty = qna_session.difficulty
+            new_mastery = mastery.rating
+        finally:
+            db.close()
         
         if points_earned > 0:
             award_points(session['user_id'], points_earned, f"QnA Session: {topic} ({difficulty})")
@@ -683,14 +2043,16 @@ def submit_qna_answers():
             'total_questions': total_questions,
             'percentage': round((correct_answers / total_questions) * 100, 1),
             'points_earned': points_earned,
-            'difficulty': difficulty
+            'difficulty': difficulty,
+            'mastery': round(new_mastery, 3),
+            'next_difficulty': closest_difficulty(new_mastery - QUIZ_TARGET_OFFSET)
         })
         
     except Exception as e:
         print(f"Error submitting QnA answers: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/points/transactions', methods=['GET'])
+@bp.route('/api/points/transactions', methods=['GET'])
 def get_points_history():
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
@@ -716,15 +2078,466 @@ def get_points_history():
 # ============================================================================
 # FILE UPLOAD ROUTES
 # ============================================================================
-@app.route('/uploads/<folder>/<filename>')
+@bp.route('/uploads/<folder>/<filename>')
 def uploaded_file(folder, filename):
     """Serve uploaded files"""
-    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], folder), filename)
+    return send_from_directory(os.path.join(current_app.config['UPLOAD_FOLDER'], folder), filename)
+
+# ============================================================================
+# DOUBT ROUTING QUEUE
+# ============================================================================
+class IndexedHeap:
+    """Binary min-heap with a position index, so any item can be updated or removed in O(log n)"""
+
+    def __init__(self):
+        self.heap = []  # [priority, item] pairs
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def _swap(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.positions[self.heap[i][1]] = i
+        self.positions[self.heap[j][1]] = j
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self.heap[i][0] >= self.heap[parent][0]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        size = len(self.heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and self.heap[child][0] < self.heap[smallest][0]:
+                    smallest = child
+            if smallest == i:
+                return
+            self._swap(i, smallest)
+            i = smallest
+
+    def push(self, item, priority):
+        """Insert an item, or move it if it is already queued"""
+        if item in self.positions:
+            i = self.positions[item]
+            self.heap[i][0] = priority
+            self._sift_up(i)
+            self._sift_down(self.positions[item])
+            return
+        self.heap.append([priority, item])
+        self.positions[item] = len(self.heap) - 1
+        self._sift_up(len(self.heap) - 1)
+
+    def peek(self):
+        return tuple(self.heap[0]) if self.heap else None
+
+    def remove(self, item):
+        i = self.positions.pop(item, None)
+        if i is None:
+            return False
+        last = self.heap.pop()
+        if i < len(self.heap):
+            self.heap[i] = last
+            self.positions[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self.positions[last[1]])
+        return True
+
+    def pop(self):
+        if not self.heap:
+            return None
+        priority, item = self.heap[0]
+        self.remove(item)
+        return priority, item
+
+def normalize_subject(value):
+    return (value or '').strip().lower()
+
+class DoubtRouter:
+    """Pending doubts indexed for subject-aware claims, plus a heap of lease expiries.
+
+    Each pending doubt sits in the heap for the teacher subject its topic matches
+    (or the general heap) and in a heap of all pending doubts. Priority is
+    (time the student started waiting, doubt created_at, id): the oldest doubts
+    come first, and a student whose earlier doubts are still open is served
+    ahead of newer askers. The doubt_leases table stays the source of truth for
+    who holds a doubt; this index only decides which doubt to try next.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.subjects = set()
+        self.by_subject = {}  # subject (None for general) -> IndexedHeap
+        self.all_pending = IndexedHeap()
+        self.leases = IndexedHeap()  # doubt_id keyed by lease expiry timestamp
+        self.doubts = {}  # doubt_id -> (subject, priority)
+        self.built_at = None
+
+    def reset(self, subjects):
+        self.subjects = {subject for subject in subjects if subject}
+        self.by_subject = {}
+        self.all_pending = IndexedHeap()
+        self.leases = IndexedHeap()
+        self.doubts = {}
+
+    def match_subject(self, topic):
+        topic = normalize_subject(topic)
+        for subject in self.subjects:
+            if subject and subject in topic:
+                return subject
+        return None
+
+    def add(self, doubt_id, topic, priority):
+        with self.lock:
+            subject = self.match_subject(topic)
+            self.doubts[doubt_id] = (subject, priority)
+            self._enqueue(doubt_id)
+
+    def _enqueue(self, doubt_id):
+        subject, priority = self.doubts[doubt_id]
+        self.by_subject.setdefault(subject, IndexedHeap()).push(doubt_id, priority)
+        self.all_pending.push(doubt_id, priority)
+
+    def _dequeue(self, doubt_id):
+        subject, _ = self.doubts[doubt_id]
+        self.by_subject[subject].remove(doubt_id)
+        self.all_pending.remove(doubt_id)
+
+    def lease(self, doubt_id, expires_at):
+        """Take a doubt out of the pending heaps until its lease expires"""
+        with self.lock:
+            if doubt_id not in self.doubts:
+                return
+            self._dequeue(doubt_id)
+            self.leases.push(doubt_id, expires_at.timestamp())
+
+    def release(self, doubt_id):
+        """Put a leased doubt back in line with its original priority"""
+        with self.lock:
+            if self.leases.remove(doubt_id) and doubt_id in self.doubts:
+                self._enqueue(doubt_id)
+
+    def remove(self, doubt_id):
+        """Forget a doubt that has been answered"""
+        with self.lock:
+            if doubt_id in self.doubts:
+                self._dequeue(doubt_id)
+                self.leases.remove(doubt_id)
+                del self.doubts[doubt_id]
+
+    def expire(self, now):
+        """Return every doubt whose lease ran out to the pending heaps"""
+        with self.lock:
+            while self.leases.peek() and self.leases.peek()[0] <= now.timestamp():
+                _, doubt_id = self.leases.pop()
+                if doubt_id in self.doubts:
+                    self._enqueue(doubt_id)
+
+    def next_for(self, subject):
+        """Best pending doubt for a teacher: their subject, then general doubts, then anything"""
+        with self.lock:
+            subject = normalize_subject(subject)
+            heaps = [self.by_subject.get(subject), self.by_subject.get(None)] if subject else []
+            for heap in heaps + [self.all_pending]:
+                if heap:
+                    return heap.peek()[1]
+            return None
+
+    def stats(self, now):
+        with self.lock:
+            oldest = self.all_pending.peek()
+            return {
+                'pending': len(self.all_pending),
+                'leased': len(self.leases),
+                'oldest_wait_seconds': int(now.timestamp() - oldest[0][1]) if oldest else 0,
+                'pending_by_subject': {subject or 'general': len(heap) for subject, heap in self.by_subject.items() if len(heap)}
+            }
+
+doubt_router = DoubtRouter()
+
+def rebuild_doubt_router():
+    """Reload pending doubts and live leases from the database"""
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        subjects = {normalize_subject(s) for (s,) in db.query(Profile.subject).filter(Profile.role == 'teacher', Profile.subject.isnot(None))}
+        pending = db.query(Doubt.id, Doubt.student_id, Doubt.topic, Doubt.created_at)\
+            .filter(Doubt.status == 'pending').order_by(Doubt.created_at).all()
+        leases = db.query(DoubtLease).filter(DoubtLease.expires_at > now).all()
+    finally:
+        db.close()
+
+    with doubt_router.lock:
+        doubt_router.reset(subjects)
+        waiting_since = {}
+        for doubt_id, student_id, topic, created_at in pending:
+            # Rows come oldest first, so the first doubt seen is when the student started waiting
+            since = waiting_since.setdefault(student_id, created_at)
+            doubt_router.add(doubt_id, topic, (since.timestamp(), created_at.timestamp(), doubt_id))
+        for lease in leases:
+            doubt_router.lease(lease.doubt_id, lease.expires_at)
+        doubt_router.built_at = time.time()
+
+def ensure_doubt_router():
+    if doubt_router.built_at is None or time.time() - doubt_router.built_at > DOUBT_QUEUE_REFRESH_SECONDS:
+        rebuild_doubt_router()
+    doubt_router.expire(datetime.utcnow())
+
+def route_new_doubt(doubt):
+    """Add a freshly committed doubt to this worker's routing index"""
+    if doubt_router.built_at is None:
+        return
+    db = SessionLocal()
+    try:
+        since = db.query(func.min(Doubt.created_at)).filter(
+            Doubt.student_id == doubt.student_id, Doubt.status == 'pending').scalar() or doubt.created_at
+    finally:
+        db.close()
+    doubt_router.add(doubt.id, doubt.topic, (since.timestamp(), doubt.created_at.timestamp(), doubt.id))
+
+def try_lease_doubt(db, doubt_id, teacher_id, now):
+    """Atomically take or extend a lease; fails while another teacher's lease is live"""
+    expires_at = now + timedelta(seconds=DOUBT_LEASE_SECONDS)
+    stmt = sqlite_insert(DoubtLease).values(doubt_id=doubt_id, teacher_id=teacher_id, claimed_at=now, expires_at=expires_at)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['doubt_id'],
+        set_={'teacher_id': stmt.excluded.teacher_id, 'claimed_at': stmt.excluded.claimed_at, 'expires_at': stmt.excluded.expires_at},
+        where=(DoubtLease.expires_at <= now) | (DoubtLease.teacher_id == teacher_id)
+    )
+    if db.connection().execute(stmt).rowcount:
+        return expires_at
+    return None
+
+def format_teacher_doubt(doubt, student_name, teacher_id=None, lease=None, draft=None):
+    return {
+        'id': doubt.id,
+        'topic': doubt.topic,
+        'question': doubt.question,
+        'question_image': doubt.question_image,
+        'status': doubt.status,
+        'created_at': doubt.created_at.isoformat(),
+        'student_name': student_name,
+        'answer': doubt.answer,
+        'answer_image': doubt.answer_image,
+        'answered_at': doubt.answered_at.isoformat() if doubt.answered_at else None,
+        'rating': doubt.rating,
+        'upvoted': doubt.upvoted,
+        'downvoted': doubt.downvoted,
+        'student_comment': doubt.student_comment,
+        'teacher_reply': doubt.teacher_reply,
+        'final_rating': doubt.final_rating,
+        'final_upvoted': doubt.final_upvoted,
+        'points_awarded': doubt.points_awarded,
+        'claimed_by_me': bool(lease and lease.teacher_id == teacher_id),
+        'claimed_by_other': bool(lease and lease.teacher_id != teacher_id),
+        'lease_expires_at': lease.expires_at.isoformat() if lease else None,
+        'archived': isinstance(doubt, ArchivedDoubt),
+        'ai_draft': draft
+    }
+
+@bp.route('/api/teacher/doubts/claim', methods=['POST'])
+def claim_doubt():
+    """Lease the next doubt in line for this teacher, or a specific doubt by id"""
+    if 'user_id' not in session or session.get('user_role') != 'teacher':
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    requested_id = data.get('doubt_id')
+    if requested_id is not None:
+        try:
+            requested_id = int(requested_id)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'doubt_id must be a positive integer'}), 400
+        if requested_id <= 0:
+            return jsonify({'success': False, 'error': 'doubt_id must be a positive integer'}), 400
+    teacher_id = session['user_id']
+    teacher = get_user_by_id(teacher_id)
+    if not teacher:
+        return jsonify({'success': False, 'error': 'Teacher not found'}), 404
+    ensure_doubt_router()
+
+    db = SessionLocal()
+    try:
+        # Bounded so a burst of stale index entries can't keep the request spinning
+        for _ in range(20):
+            doubt_id = requested_id or doubt_router.next_for(teacher.subject)
+            if doubt_id is None:
+                return jsonify({'success': False, 'error': 'No doubts are waiting right now'}), 404
+            
+            now = datetime.utcnow()
+            expires_at = try_lease_doubt(db, doubt_id, teacher_id, now)
+            doubt = db.query(Doubt).filter(Doubt.id == doubt_id).first()
+            if not doubt or doubt.status != 'pending':
+                db.rollback()
+                doubt_router.remove(doubt_id)
+                if requested_id:
+                    return jsonify({'success': False, 'error': 'Doubt is no longer pending'}), 409
+                continue
+            if not expires_at:
+                # Another worker's teacher holds it; park it here until that lease runs out
+                lease = db.query(DoubtLease).filter(DoubtLease.doubt_id == doubt_id).first()
+                db.rollback()
+                doubt_router.lease(doubt_id, lease.expires_at)
+                if requested_id:
+                    return jsonify({'success': False, 'error': 'Another teacher is answering this doubt'}), 409
+                continue
+            
+            db.commit()
+            doubt_router.lease(doubt_id, expires_at)
+            student = db.query(Profile).filter(Profile.id == doubt.student_id).first()
+            lease = db.query(DoubtLease).filter(DoubtLease.doubt_id == doubt_id).first()
+            draft = db.query(DoubtDraft.draft).filter(DoubtDraft.doubt_id == doubt_id).scalar()
+            return jsonify({
+                'success': True,
+                'doubt': format_teacher_doubt(doubt, student.name if student else 'Unknown', teacher_id, lease, draft),
+                'lease_expires_at': expires_at.isoformat()
+            })
+        return jsonify({'success': False, 'error': 'No doubts are waiting right now'}), 404
+    finally:
+        db.close()
+
+@bp.route('/api/teacher/doubts/<int:doubt_id>/renew', methods=['POST'])
+def renew_doubt_lease(doubt_id):
+    """Extend this teacher's lease on a doubt they are still working on"""
+    if 'user_id' not in session or session.get('user_role') != 'teacher':
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        held = db.query(DoubtLease).filter(DoubtLease.doubt_id == doubt_id, DoubtLease.teacher_id == session['user_id'],
+                                           DoubtLease.expires_at > now).first()
+        if not held:
+            return jsonify({'success': False, 'error': 'You do not hold this doubt'}), 409
+        expires_at = try_lease_doubt(db, doubt_id, session['user_id'], now)
+        db.commit()
+    finally:
+        db.close()
+    
+    doubt_router.lease(doubt_id, expires_at)
+    return jsonify({'success': True, 'lease_expires_at': expires_at.isoformat()})
+
+@bp.route('/api/teacher/doubts/<int:doubt_id>/release', methods=['POST'])
+def release_doubt_lease(doubt_id):
+    """Hand a claimed doubt back to the queue"""
+    if 'user_id' not in session or session.get('user_role') != 'teacher':
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    db = SessionLocal()
+    try:
+        released = db.query(DoubtLease).filter(DoubtLease.doubt_id == doubt_id, DoubtLease.teacher_id == session['user_id'])\
+            .delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    
+    if released:
+        doubt_router.release(doubt_id)
+    return jsonify({'success': True, 'released': bool(released)})
+
+@bp.route('/api/teacher/queue/stats', methods=['GET'])
+def get_doubt_queue_stats():
+    """Queue depth, oldest wait and recent time-to-first-answer"""
+    if 'user_id' not in session or session.get('user_role') != 'teacher':
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    ensure_doubt_router()
+    db = SessionLocal()
+    try:
+        since = datetime.utcnow() - timedelta(days=7)
+        avg_days = db.query(func.avg(func.julianday(Doubt.answered_at) - func.julianday(Doubt.created_at)))\
+            .filter(Doubt.answered_at.isnot(None), Doubt.answered_at >= since).scalar()
+    finally:
+        db.close()
+    
+    stats = doubt_router.stats(datetime.utcnow())
+    stats['avg_time_to_first_answer_minutes_7d'] = round(avg_days * 24 * 60, 1) if avg_days is not None else None
+    return jsonify({'success': True, 'stats': stats})
+
+# ============================================================================
+# AI DRAFT ANSWERS
+# ============================================================================
+class DraftInProgress(Exception):
+    """Another job is drafting an identical question; retrying later picks up its result"""
+
+def doubt_question_hash(topic, question):
+    normalised = f"{flashcard_topic_key(topic)}\n{' '.join(question.lower().split())}"
+    return hashlib.sha256(normalised.encode()).hexdigest()
+
+def write_draft_answer(topic, question):
+    prompt = f"""A student asked the following doubt about "{topic}":
+
+    {question}
+
+    Write a clear, correct answer a teacher could send after a quick review. Explain step by step where it helps,
+    keep it under 250 words, and don't mention that you are an AI."""
+    return llm_chat('doubt_draft', [
+        {"role": "system", "content": "You are an experienced, encouraging teacher."},
+        {"role": "user", "content": prompt}
+    ], model="gpt-3.5-turbo", max_tokens=450, temperature=0.4).strip()
+
+@job_handler('draft_doubt_answer')
+def draft_doubt_answer(doubt_id):
+    """Attach a draft answer to a new doubt, reusing the draft of an identical question when there is one"""
+    db = SessionLocal()
+    try:
+        doubt = db.query(Doubt).filter(Doubt.id == doubt_id).first()
+        if not doubt or doubt.status != 'pending' or db.get(DoubtDraft, doubt_id):
+            return {'skipped': True}
+        question_hash = doubt_question_hash(doubt.topic, doubt.question)
+        now = datetime.utcnow()
+        
+        # The cache row doubles as a lock so identical questions cost one model call
+        claimed = db.execute(
+            sqlite_insert(DraftCache).values(question_hash=question_hash, status='generating', updated_at=now)
+            .on_conflict_do_update(index_elements=['question_hash'],
+                                   set_={'status': 'generating', 'updated_at': now},
+                                   where=and_(DraftCache.status == 'generating',
+                                              DraftCache.updated_at < now - timedelta(seconds=JOB_VISIBILITY_TIMEOUT)))
+            .returning(DraftCache.question_hash)
+        ).first()
+        db.commit()
+        
+        if not claimed:
+            entry = db.get(DraftCache, question_hash)
+            if entry is None or entry.status != 'ready':
+                raise DraftInProgress(f"draft for {question_hash[:12]} is still being generated")
+            draft, cached = entry.draft, True
+        else:
+            try:
+                # Background drafts share the global budget with interactive AI requests
+                with engine.begin() as conn:
+                    take_bucket_tokens(conn, 'global', 1, AI_GLOBAL_BUCKET_CAPACITY, AI_GLOBAL_REFILL_PER_MINUTE, time.time())
+                draft = write_draft_answer(doubt.topic, doubt.question)
+            except Exception:
+                db.query(DraftCache).filter(DraftCache.question_hash == question_hash).delete(synchronize_session=False)
+                db.commit()
+                raise
+            db.query(DraftCache).filter(DraftCache.question_hash == question_hash).update(
+                {'status': 'ready', 'draft': draft, 'updated_at': datetime.utcnow()}, synchronize_session=False)
+            cached = False
+        
+        db.execute(sqlite_insert(DoubtDraft).values(doubt_id=doubt_id, question_hash=question_hash, draft=draft,
+                                                    cached=cached, created_at=datetime.utcnow())
+                   .on_conflict_do_nothing())
+        db.commit()
+        return {'doubt_id': doubt_id, 'cached': cached}
+    finally:
+        db.close()
+
 
 # ============================================================================
 # TEACHER DOUBT MANAGEMENT API
 # ============================================================================
-@app.route('/api/teacher/doubts', methods=['GET'])
+@bp.route('/api/teacher/doubts', methods=['GET'])
 def get_teacher_doubts():
     """Get all doubts for teachers to answer"""
     if 'user_id' not in session or session.get('user_role') != 'teacher':
@@ -733,36 +2546,24 @@ def get_teacher_doubts():
     db = SessionLocal()
     try:
         doubts = db.query(Doubt).filter(Doubt.status.in_(['pending', 'answered', 'resolved'])).order_by(Doubt.created_at.desc()).all()
+        if request.args.get('include_archived') == '1':
+            doubts += db.query(ArchivedDoubt).order_by(ArchivedDoubt.created_at.desc()).all()
+        leases = {lease.doubt_id: lease for lease in db.query(DoubtLease).filter(DoubtLease.expires_at > datetime.utcnow())}
+        student_ids = {doubt.student_id for doubt in doubts}
+        names = dict(db.query(Profile.id, Profile.name).filter(Profile.id.in_(student_ids))) if student_ids else {}
+        pending_ids = [doubt.id for doubt in doubts if doubt.status == 'pending']
+        drafts = dict(db.query(DoubtDraft.doubt_id, DoubtDraft.draft).filter(DoubtDraft.doubt_id.in_(pending_ids))) if pending_ids else {}
         
         formatted_doubts = []
         for doubt in doubts:
-            student = db.query(Profile).filter(Profile.id == doubt.student_id).first()
-            formatted_doubts.append({
-                'id': doubt.id,
-                'topic': doubt.topic,
-                'question': doubt.question,
-                'question_image': doubt.question_image,
-                'status': doubt.status,
-                'created_at': doubt.created_at.isoformat(),
-                'student_name': student.name if student else 'Unknown',
-                'answer': doubt.answer,
-                'answer_image': doubt.answer_image,
-                'answered_at': doubt.answered_at.isoformat() if doubt.answered_at else None,
-                'rating': doubt.rating,
-                'upvoted': doubt.upvoted,
-                'downvoted': doubt.downvoted,
-                'student_comment': doubt.student_comment,
-                'teacher_reply': doubt.teacher_reply,
-                'final_rating': doubt.final_rating,
-                'final_upvoted': doubt.final_upvoted,
-                'points_awarded': doubt.points_awarded
-            })
+            formatted_doubts.append(format_teacher_doubt(
+                doubt, names.get(doubt.student_id, 'Unknown'), session['user_id'], leases.get(doubt.id), drafts.get(doubt.id)))
         
         return jsonify({'success': True, 'doubts': formatted_doubts})
     finally:
         db.close()
 
-@app.route('/api/teacher/answer-doubt', methods=['POST'])
+@bp.route('/api/teacher/answer-doubt', methods=['POST'])
 def answer_doubt():
     """Teacher answers a doubt"""
     if 'user_id' not in session or session.get('user_role') != 'teacher':
@@ -783,9 +2584,18 @@ def answer_doubt():
         if not doubt_id or not answer:
             return jsonify({'success': False, 'error': 'Doubt ID and answer are required'}), 400
         
+        # Take the lease first so two teachers can't write answers to the same doubt
+        if not try_lease_doubt(db, doubt_id, session['user_id'], datetime.utcnow()):
+            db.rollback()
+            return jsonify({'success': False, 'error': 'Another teacher is answering this doubt'}), 409
+        
         doubt = db.query(Doubt).filter(Doubt.id == doubt_id).first()
         if not doubt:
+            db.rollback()
             return jsonify({'success': False, 'error': 'Doubt not found'}), 404
+        if doubt.status != 'pending' and doubt.teacher_id != session['user_id']:
+            db.rollback()
+            return jsonify({'success': False, 'error': 'This doubt was already answered by another teacher'}), 409
         
         answer_image_filename = None
         if answer_image:
@@ -796,14 +2606,16 @@ def answer_doubt():
         doubt.teacher_id = session['user_id']
         doubt.status = 'answered'
         doubt.answered_at = datetime.utcnow()
+        db.query(DoubtLease).filter(DoubtLease.doubt_id == doubt.id).delete(synchronize_session=False)
         
         db.commit()
+        doubt_router.remove(doubt.id)
         
         return jsonify({'success': True, 'message': 'Doubt answered successfully'})
     finally:
         db.close()
 
-@app.route('/api/teacher/reply-to-comment', methods=['POST'])
+@bp.route('/api/teacher/reply-to-comment', methods=['POST'])
 def reply_to_student_comment():
     """Teacher replies to student's comment"""
     if 'user_id' not in session or session.get('user_role') != 'teacher':
@@ -829,7 +2641,7 @@ def reply_to_student_comment():
     finally:
         db.close()
 
-@app.route('/api/teacher/stats', methods=['GET'])
+@bp.route('/api/teacher/stats', methods=['GET'])
 def get_teacher_stats():
     """Get teacher performance statistics"""
     if 'user_id' not in session or session.get('user_role') != 'teacher':
@@ -837,32 +2649,32 @@ def get_teacher_stats():
     
     db = SessionLocal()
     try:
-        total_doubts_answered = db.query(Doubt).filter(
-            Doubt.teacher_id == session['user_id'],
-            Doubt.status.in_(['answered', 'resolved'])
-        ).count()
-        
-        total_points_earned = db.query(Doubt).filter(
-            Doubt.teacher_id == session['user_id'],
-            Doubt.points_awarded > 0
-        ).with_entities(func.sum(Doubt.points_awarded)).scalar() or 0
-        
-        avg_rating = db.query(Doubt).filter(
-            Doubt.teacher_id == session['user_id'],
-            Doubt.final_rating.isnot(None)
-        ).with_entities(func.avg(Doubt.final_rating)).scalar() or 0
-        
-        return jsonify({
-            'success': True,
-            'stats': {
-                'total_doubts_answered': total_doubts_answered,
-                'total_points_earned': total_points_earned,
-                'average_rating': round(avg_rating, 1)
-            }
-        })
+        return jsonify({'success': True, 'stats': teacher_answer_stats(db, session['user_id'])})
     finally:
         db.close()
 
+def teacher_answer_stats(db, teacher_id):
+    """Answer count, points and average final rating; served entirely from the (teacher_id, status, ...) indexes"""
+    total_doubts_answered = total_points_earned = rating_sum = rating_count = 0
+    # Archived doubts still count towards a teacher's totals
+    for model in [Doubt, ArchivedDoubt]:
+        answered, points, ratings, rated = db.query(
+            func.count(model.id),
+            func.sum(model.points_awarded),
+            func.sum(model.final_rating),
+            func.count(model.final_rating)
+        ).filter(model.teacher_id == teacher_id, model.status.in_(['answered', 'resolved'])).one()
+        total_doubts_answered += answered
+        total_points_earned += points or 0
+        rating_sum += ratings or 0
+        rating_count += rated
+    avg_rating = rating_sum / rating_count if rating_count else 0
+    return {
+        'total_doubts_answered': total_doubts_answered,
+        'total_points_earned': total_points_earned,
+        'average_rating': round(avg_rating, 1)
+    }
+
 def get_points_icon(reason):
     """Get appropriate icon for different point earning activities"""
     if 'QnA' in reason:
@@ -879,7 +2691,7 @@ def get_points_icon(reason):
 # ============================================================================
 # STUDENT DOUBT FEEDBACK API
 # ============================================================================
-@app.route('/api/student/rate-answer', methods=['POST'])
+@bp.route('/api/student/rate-answer', methods=['POST'])
 def rate_teacher_answer():
     """Student rates teacher's answer"""
     if 'user_id' not in session:
@@ -928,7 +2740,7 @@ def rate_teacher_answer():
     finally:
         db.close()
 
-@app.route('/api/student/final-rating', methods=['POST'])
+@bp.route('/api/student/final-rating', methods=['POST'])
 def submit_final_rating():
     """Student submits final rating after communication"""
     if 'user_id' not in session:
@@ -967,73 +2779,1581 @@ def submit_final_rating():
 
 
 # ============================================================================
-# NEW: FLASHCARD GENERATOR API ENDPOINT
+# ADAPTIVE QUIZ MASTERY
 # ============================================================================
-@app.route('/api/flashcards/generate', methods=['POST'])
-def generate_flashcards():
-    """Generate summary flashcards for a topic using OpenAI"""
-    if 'user_id' not in session or session.get('user_role') != 'student':
-        return jsonify({'success': False, 'error': 'Access denied'}), 403
+# Students and questions share one logit scale (a Rasch/Elo model): a student
+# with rating r answers an item with rating b correctly with p = 1 / (1 + e^(b - r)).
+QUIZ_DIFFICULTY_RATINGS = {'easy': -1.0, 'medium': 0.0, 'hard': 1.0}  # Starting item ratings per wording
+QUIZ_POINTS = {'easy': 10, 'medium': 15, 'hard': 20}  # Points per correct answer
+QUIZ_TARGET_SUCCESS = 0.7  # Serve questions the student should get right this often
+QUIZ_TARGET_OFFSET = math.log(QUIZ_TARGET_SUCCESS / (1 - QUIZ_TARGET_SUCCESS))
+QUIZ_QUESTION_COUNT = 5
+QUIZ_STUDENT_K = 0.4  # Elo step sizes; they shrink as attempts accumulate
+QUIZ_ITEM_K = 0.2
 
-    try:
-        data = request.get_json()
-        topic = data.get('topic', '').strip()
+def closest_difficulty(rating):
+    return min(QUIZ_DIFFICULTY_RATINGS, key=lambda d: abs(QUIZ_DIFFICULTY_RATINGS[d] - rating))
 
-        if not topic:
-            return jsonify({'success': False, 'error': 'Topic is required'}), 400
+def get_topic_mastery(db, student_id, topic_key):
+    """The student's mastery row for a topic, created at rating 0 if it's their first quiz"""
+    mastery = db.get(TopicMastery, (student_id, topic_key))
+    if mastery is None:
+        # Two first submits can race here; whichever insert lands first wins and both load that row
+        db.execute(sqlite_insert(TopicMastery).values(student_id=student_id, topic_key=topic_key, rating=0.0,
+                                                      attempts=0, updated_at=datetime.utcnow())
+                   .on_conflict_do_nothing())
+        mastery = db.get(TopicMastery, (student_id, topic_key))
+    return mastery
 
-        prompt = f"""
-        Generate 5 concise flashcards for a student on the topic: "{topic}".
-        The flashcards should be for last-minute revision.
-        Provide the response as a valid JSON array of objects.
-        Each object must have two keys: "term" and "definition".
-        
-        Example format:
-        [
-          {{"term": "Term 1", "definition": "Definition 1."}},
-          {{"term": "Term 2", "definition": "Definition 2."}}
-        ]
-        
-        Do not include any text outside of the JSON array.
-        """
+def ensure_quiz_items(db, topic):
+    """Seed a topic's question bank (every wording of every question) on first use"""
+    topic_key = flashcard_topic_key(topic)
+    rows = []
+    for difficulty, rating in QUIZ_DIFFICULTY_RATINGS.items():
+        for position, question in enumerate(generate_simple_questions(topic, difficulty)):
+            rows.append({'topic_key': topic_key, 'difficulty': difficulty, 'position': position,
+                         'question': json.dumps(question), 'rating': rating, 'attempts': 0})
+    db.connection().execute(sqlite_insert(QuizItem).on_conflict_do_nothing(), rows)
 
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are an expert educational content creator who provides responses in perfect JSON format."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500,
-            temperature=0.6
-        )
+def pick_quiz_items(db, topic, target):
+    """One wording per question, the one whose rating is closest to target"""
+    topic_key = flashcard_topic_key(topic)
+    items = db.query(QuizItem).filter(QuizItem.topic_key == topic_key).all()
+    if not items:
+        ensure_quiz_items(db, topic)
+        items = db.query(QuizItem).filter(QuizItem.topic_key == topic_key).all()
+    best = {}
+    for item in items:
+        current = best.get(item.position)
+        if current is None or abs(item.rating - target) < abs(current.rating - target):
+            best[item.position] = item
+    return [best[position] for position in sorted(best)][:QUIZ_QUESTION_COUNT]
 
-        content = response.choices[0].message.content
-        
-        try:
-            json_start = content.find('[')
-            json_end = content.rfind(']') + 1
-            if json_start == -1 or json_end == 0:
-                raise ValueError("No JSON array found in the AI response.")
-            
-            json_content = content[json_start:json_end]
-            flashcards = json.loads(json_content)
-            
-            if not isinstance(flashcards, list) or not all("term" in d and "definition" in d for d in flashcards):
-                raise ValueError("Invalid flashcard structure received from AI")
+def update_mastery(db, mastery, item, correct):
+    """O(1) Elo update of the student's topic rating and the item's rating for one graded answer"""
+    expected = 1 / (1 + math.exp(item.rating - mastery.rating))
+    surprise = (1 if correct else 0) - expected
+    mastery.rating += QUIZ_STUDENT_K / (1 + 0.05 * (mastery.attempts or 0)) * surprise
+    mastery.attempts = (mastery.attempts or 0) + 1
+    mastery.updated_at = datetime.utcnow()
+    # Items are shared across students, so apply the delta in SQL rather than overwriting
+    step = QUIZ_ITEM_K / (1 + 0.01 * (item.attempts or 0)) * surprise
+    db.query(QuizItem).filter(QuizItem.id == item.id).update(
+        {QuizItem.rating: QuizItem.rating - step, QuizItem.attempts: QuizItem.attempts + 1},
+        synchronize_session=False)
+    return expected
 
-            return jsonify({'success': True, 'flashcards': flashcards})
+@job_handler('recalibrate_mastery')
+def recalibrate_mastery(iterations=30, prior=0.1):
+    """Refit every student-topic and item rating by regularised maximum likelihood over the full answer history.
 
-        except (json.JSONDecodeError, ValueError) as e:
-            print(f"Error parsing OpenAI response: {e}\nRaw content: {content}")
-            return jsonify({'success': False, 'error': 'Failed to get a valid response from the AI. Please try a different topic.'}), 500
+    Online Elo updates drift with answer order; this batch fit replaces them with
+    the ratings that best explain all answers at once. Each iteration is a handful
+    of vectorised passes over the history, so it scales to millions of answers.
+    """
+    import numpy as np
 
-    except Exception as e:
+    started = time.time()
+    db = SessionLocal()
+    try:
+        history = db.execute(
+            select(QuizAnswer.student_id, QuizItem.topic_key, QuizAnswer.item_id, QuizAnswer.correct)
+            .join(QuizItem, QuizItem.id == QuizAnswer.item_id)
+        ).all()
+        if not history:
+            return {'answers': 0, 'students': 0, 'items': 0, 'seconds': 0.0}
+
+        student_ids, topic_keys, item_ids, correct = zip(*history)
+        y = np.asarray(correct, dtype=np.float64)
+        topics, topic_index = np.unique(np.asarray(topic_keys), return_inverse=True)
+        pairs, s = np.unique(np.asarray(student_ids, dtype=np.int64) * len(topics) + topic_index, return_inverse=True)
+        items, i = np.unique(np.asarray(item_ids, dtype=np.int64), return_inverse=True)
+
+        # Warm-start from the online ratings and shrink items towards their wording's starting rating
+        item_rows = {row.id: row for row in db.query(QuizItem.id, QuizItem.rating, QuizItem.difficulty).filter(QuizItem.id.in_(items.tolist()))}
+        b = np.array([item_rows[x].rating for x in items.tolist()])
+        b0 = np.array([QUIZ_DIFFICULTY_RATINGS.get(item_rows[x].difficulty, 0.0) for x in items.tolist()])
+        pair_students = pairs // len(topics)
+        pair_topics = topics[pairs % len(topics)]
+        current = {(m.student_id, m.topic_key): m.rating for m in db.query(TopicMastery).filter(TopicMastery.topic_key.in_(topics.tolist()))}
+        theta = np.array([current.get((int(st), str(tk)), 0.0) for st, tk in zip(pair_students, pair_topics)])
+
+        student_count = np.bincount(s, minlength=len(pairs))
+        item_count = np.bincount(i, minlength=len(items))
+        for _ in range(iterations):
+            # One Newton step per parameter block, alternating students and items
+            p = 1 / (1 + np.exp(b[i] - theta[s]))
+            grad = np.bincount(s, y - p, len(pairs)) - prior * theta
+            hess = np.bincount(s, p * (1 - p), len(pairs)) + prior
+            theta += np.clip(grad / hess, -1, 1)
+            p = 1 / (1 + np.exp(b[i] - theta[s]))
+            grad = np.bincount(i, p - y, len(items)) - prior * (b - b0)
+            hess = np.bincount(i, p * (1 - p), len(items)) + prior
+            b += np.clip(grad / hess, -1, 1)
+
+        now = datetime.utcnow()
+        db.execute(update(QuizItem), [
+            {'id': int(x), 'rating': float(r), 'attempts': int(n)} for x, r, n in zip(items, b, item_count)
+        ])
+        upsert = sqlite_insert(TopicMastery)
+        db.connection().execute(
+            upsert.on_conflict_do_update(
+                index_elements=['student_id', 'topic_key'],
+                set_={'rating': upsert.excluded.rating, 'attempts': upsert.excluded.attempts,
+                      'updated_at': upsert.excluded.updated_at}),
+            [{'student_id': int(st), 'topic_key': str(tk), 'rating': float(r), 'attempts': int(n), 'updated_at': now}
+             for st, tk, r, n in zip(pair_students, pair_topics, theta, student_count)]
+        )
+        db.commit()
+        return {'answers': len(y), 'students': len(pairs), 'items': len(items),
+                'seconds': round(time.time() - started, 3)}
+    finally:
+        db.close()
+
+@bp.route('/api/qna/mastery', methods=['GET'])
+def get_quiz_mastery():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    db = SessionLocal()
+    try:
+        rows = db.query(TopicMastery).filter(TopicMastery.student_id == session['user_id']) \
+            .order_by(TopicMastery.updated_at.desc()).all()
+        return jsonify({'success': True, 'mastery': [{
+            'topic': m.topic_key,
+            'rating': round(m.rating, 3),
+            'attempts': m.attempts,
+            'next_difficulty': closest_difficulty(m.rating - QUIZ_TARGET_OFFSET)
+        } for m in rows]})
+    finally:
+        db.close()
+
+
+# ============================================================================
+# NEW: FLASHCARD GENERATOR API ENDPOINT
+# ============================================================================
+FLASHCARDS_PER_DECK = 5
+FLASHCARD_MAX_ATTEMPTS = 3  # Model calls spent on one deck, topping up cards a short or malformed reply missed
+FLASHCARD_FUNCTION = {
+    'name': 'save_flashcards',
+    'description': 'Save revision flashcards for a student.',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'flashcards': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'term': {'type': 'string', 'description': 'A short term or question'},
+                        'definition': {'type': 'string', 'description': 'A concise definition or answer'}
+                    },
+                    'required': ['term', 'definition']
+                }
+            }
+        },
+        'required': ['flashcards']
+    }
+}
+
+class CardStreamParser:
+    """Incremental JSON scanner that returns each object in an array as soon as its closing brace arrives.
+
+    Both {"flashcards": [...]} and a bare [...] stream, text around the JSON is
+    ignored, and a malformed object is dropped without losing the ones after it.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.start = None
+        self.start_depth = None
+
+    def feed(self, text):
+        """Consume more text; returns the objects it completed"""
+        objects = []
+        offset = len(self.buffer)
+        self.buffer += text
+        for i in range(offset, len(self.buffer)):
+            char = self.buffer[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = bool(self.stack)
+            elif char in '[{':
+                if char == '{' and self.start is None and self.stack[-1:] == ['[']:
+                    self.start, self.start_depth = i, len(self.stack)
+                self.stack.append(char)
+            elif char in ']}' and self.stack:
+                self.stack.pop()
+                if self.start is not None and len(self.stack) == self.start_depth:
+                    try:
+                        objects.append(json.loads(self.buffer[self.start:i + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self.start = None
+        # Only an unfinished object is still needed
+        self.buffer = self.buffer[self.start:] if self.start is not None else ''
+        self.start = 0 if self.start is not None else None
+        return objects
+
+def clean_flashcard(card):
+    if not isinstance(card, dict) or not isinstance(card.get('term'), str) or not isinstance(card.get('definition'), str):
+        return None
+    term, definition = card['term'].strip(), card['definition'].strip()
+    return {'term': term, 'definition': definition} if term and definition else None
+
+def flashcard_messages(topic, count, known_terms):
+    prompt = f"""Generate {count} concise flashcards for a student on the topic: "{topic}".
+        The flashcards should be for last-minute revision."""
+    if known_terms:
+        prompt += f"\n        The student already has cards for: {'; '.join(known_terms)}. Do not repeat them."
+    return [
+        {"role": "system", "content": "You are an expert educational content creator."},
+        {"role": "user", "content": prompt}
+    ]
+
+def stream_flashcards(topic, user_id=None, count=FLASHCARDS_PER_DECK):
+    """Yield validated cards for a topic as the model finishes each one.
+
+    The model is made to call save_flashcards, so its reply follows a JSON schema,
+    and the arguments are parsed while they stream. When a reply ends short or has
+    malformed cards, the good cards are kept and only the missing ones are asked
+    for again. Raises LLMUnavailable if the provider fails before any card arrives.
+    """
+    terms = []
+    for attempt in range(FLASHCARD_MAX_ATTEMPTS):
+        missing = count - len(terms)
+        if missing <= 0:
+            return
+        if attempt:
+            print(f"Flashcards for '{topic}': retrying for {missing} missing cards")
+        parser = CardStreamParser()
+        try:
+            for piece in llm_stream('flashcards', flashcard_messages(topic, missing, terms), user_id=user_id,
+                                   model="gpt-3.5-turbo", max_tokens=100 * missing + 50, temperature=0.6,
+                                   functions=[FLASHCARD_FUNCTION], function_call={'name': FLASHCARD_FUNCTION['name']}):
+                for card in map(clean_flashcard, parser.feed(piece)):
+                    if card and card['term'].lower() not in {term.lower() for term in terms}:
+                        terms.append(card['term'])
+                        yield card
+                if len(terms) >= count:
+                    break
+        except LLMUnavailable:
+            if not terms:
+                raise
+            # Keep the cards we have rather than keep calling a failing provider
+            return
+
+def create_flashcards(topic, user_id=None):
+    """Generate a deck's worth of flashcards; raises ValueError if no valid card came back"""
+    flashcards = list(stream_flashcards(topic, user_id=user_id))
+    if not flashcards:
+        raise ValueError("No valid flashcards in the AI response")
+    return flashcards
+
+def flashcard_topic_key(topic):
+    return ' '.join(topic.lower().split())
+
+def format_flashcard(card):
+    return {
+        'id': card.id,
+        'deck_id': card.deck_id,
+        'term': card.term,
+        'definition': card.definition,
+        'due_at': card.due_at.isoformat(),
+        'repetitions': card.repetitions,
+        'interval_days': card.interval_days
+    }
+
+def save_flashcard_deck(db, student_id, topic, flashcards):
+    """Store generated cards in the student's deck for this topic, skipping terms it already has"""
+    topic_key = flashcard_topic_key(topic)
+    deck = db.query(FlashcardDeck).filter(FlashcardDeck.student_id == student_id, FlashcardDeck.topic_key == topic_key).first()
+    if not deck:
+        deck = FlashcardDeck(student_id=student_id, topic=topic, topic_key=topic_key)
+        db.add(deck)
+        db.flush()
+    
+    known_terms = {term.lower() for (term,) in db.query(Flashcard.term).filter(Flashcard.deck_id == deck.id)}
+    for card in flashcards:
+        if card['term'].lower() not in known_terms:
+            known_terms.add(card['term'].lower())
+            db.add(Flashcard(deck_id=deck.id, student_id=student_id, term=card['term'], definition=card['definition']))
+    db.commit()
+    return deck
+
+def borrow_flashcards(db, topic):
+    """Cards another student already generated for this topic, for when the AI is unavailable"""
+    deck_id = db.query(FlashcardDeck.id).filter(FlashcardDeck.topic_key == flashcard_topic_key(topic)) \
+        .order_by(FlashcardDeck.created_at.desc()).limit(1).scalar()
+    if deck_id is None:
+        return []
+    return [{'term': term, 'definition': definition} for term, definition in
+            db.query(Flashcard.term, Flashcard.definition).filter(Flashcard.deck_id == deck_id).order_by(Flashcard.id)]
+
+@job_handler('generate_flashcard_deck')
+def generate_flashcard_deck(student_id, topic):
+    """Generate cards for a topic and add them to the student's deck"""
+    db = SessionLocal()
+    try:
+        degraded = False
+        try:
+            flashcards = create_flashcards(topic, user_id=student_id)
+        except LLMUnavailable:
+            flashcards = borrow_flashcards(db, topic)
+            if not flashcards:
+                raise
+            degraded = True
+        deck = save_flashcard_deck(db, student_id, topic, flashcards)
+        cards = db.query(Flashcard).filter(Flashcard.deck_id == deck.id).order_by(Flashcard.id).all()
+        return {'deck_id': deck.id, 'flashcards': [format_flashcard(c) for c in cards], 'degraded': degraded}
+    finally:
+        db.close()
+
+def stream_flashcard_deck(student_id, topic):
+    """NDJSON events for a streamed generation: {"card": ...} per card as it arrives, then the saved deck"""
+    flashcards, unavailable = [], False
+    try:
+        for card in stream_flashcards(topic, user_id=student_id):
+            flashcards.append(card)
+            yield json.dumps({'card': card}) + '\n'
+    except LLMUnavailable:
+        unavailable = True
+    
+    db = SessionLocal()
+    try:
+        degraded = False
+        if not flashcards and unavailable:
+            flashcards = borrow_flashcards(db, topic)
+            degraded = True
+            for card in flashcards:
+                yield json.dumps({'card': card}) + '\n'
+        if not flashcards:
+            error = ('Flashcard generation is temporarily unavailable. Please try again in a minute.' if unavailable
+                     else 'Failed to get a valid response from the AI. Please try a different topic.')
+            yield json.dumps({'success': False, 'error': error}) + '\n'
+            return
+        deck = save_flashcard_deck(db, student_id, topic, flashcards)
+        cards = db.query(Flashcard).filter(Flashcard.deck_id == deck.id).order_by(Flashcard.id).all()
+        yield json.dumps({'success': True, 'done': True, 'deck_id': deck.id, 'cached': False, 'degraded': degraded,
+                          'flashcards': [format_flashcard(c) for c in cards]}) + '\n'
+    except Exception as e:
+        print(f"Flashcard streaming error: {e}")
+        yield json.dumps({'success': False, 'error': 'An unexpected error occurred on the server.'}) + '\n'
+    finally:
+        db.close()
+
+def sm2_review(easiness, interval_days, repetitions, quality):
+    """Apply one SM-2 review graded 0-5; returns the new (easiness, interval_days, repetitions)"""
+    if quality < 3:
+        # Lapse: start the card over tomorrow
+        repetitions, interval_days = 0, 1
+    else:
+        if repetitions == 0:
+            interval_days = 1
+        elif repetitions == 1:
+            interval_days = 6
+        else:
+            interval_days = max(1, round(interval_days * easiness))
+        repetitions += 1
+    easiness = max(1.3, easiness + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return easiness, interval_days, repetitions
+
+@bp.route('/api/flashcards/generate', methods=['POST'])
+def generate_flashcards():
+    """Generate summary flashcards for a topic using OpenAI"""
+    if 'user_id' not in session or session.get('user_role') != 'student':
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+
+    try:
+        data = request.get_json()
+        topic = data.get('topic', '').strip()
+
+        if not topic:
+            return jsonify({'success': False, 'error': 'Topic is required'}), 400
+
+        student_id = session['user_id']
+        db = SessionLocal()
+        try:
+            # Reuse the stored deck instead of paying for the same cards again
+            if not data.get('regenerate'):
+                deck = db.query(FlashcardDeck).filter(FlashcardDeck.student_id == student_id,
+                                                      FlashcardDeck.topic_key == flashcard_topic_key(topic)).first()
+                if deck:
+                    cards = db.query(Flashcard).filter(Flashcard.deck_id == deck.id).order_by(Flashcard.id).all()
+                    if cards:
+                        return jsonify({'success': True, 'deck_id': deck.id, 'cached': True,
+                                        'flashcards': [format_flashcard(c) for c in cards]})
+        finally:
+            db.close()
+
+        limited = enforce_ai_quota('flashcards')
+        if limited:
+            return limited
+
+        # Let the client poll /api/jobs/<id> instead of holding the request open
+        if data.get('async'):
+            job_id = enqueue_job('generate_flashcard_deck', {'student_id': student_id, 'topic': topic},
+                                 user_id=student_id, max_attempts=2)
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('main.get_job_status', job_id=job_id)}), 202
+
+        # Or send each card the moment the model finishes it
+        if data.get('stream'):
+            return Response(stream_flashcard_deck(student_id, topic), mimetype='application/x-ndjson')
+
+        try:
+            result = generate_flashcard_deck(student_id, topic)
+            return jsonify({'success': True, 'deck_id': result['deck_id'], 'cached': False,
+                            'degraded': result['degraded'], 'flashcards': result['flashcards']})
+        except LLMUnavailable:
+            return jsonify({'success': False, 'error': 'Flashcard generation is temporarily unavailable. Please try again in a minute.'}), 503
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Failed to get a valid response from the AI. Please try a different topic.'}), 500
+
+    except Exception as e:
         print(f"Flashcard generation error: {e}")
         return jsonify({'success': False, 'error': 'An unexpected error occurred on the server.'}), 500
 
+@bp.route('/api/flashcards/decks', methods=['GET'])
+def list_flashcard_decks():
+    """The student's saved decks with card and due counts"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        decks = db.query(FlashcardDeck).filter(FlashcardDeck.student_id == session['user_id'])\
+            .order_by(FlashcardDeck.created_at.desc()).all()
+        totals = dict(db.query(Flashcard.deck_id, func.count(Flashcard.id))
+                      .filter(Flashcard.student_id == session['user_id']).group_by(Flashcard.deck_id).all())
+        due = dict(db.query(Flashcard.deck_id, func.count(Flashcard.id))
+                   .filter(Flashcard.student_id == session['user_id'], Flashcard.due_at <= now).group_by(Flashcard.deck_id).all())
+        return jsonify({'success': True, 'decks': [{
+            'id': d.id,
+            'topic': d.topic,
+            'cards': totals.get(d.id, 0),
+            'due': due.get(d.id, 0),
+            'created_at': d.created_at.isoformat()
+        } for d in decks]})
+    finally:
+        db.close()
+
+@bp.route('/api/flashcards/decks/<int:deck_id>', methods=['GET'])
+def get_flashcard_deck(deck_id):
+    """All cards in one of the student's decks"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    db = SessionLocal()
+    try:
+        deck = db.query(FlashcardDeck).filter(FlashcardDeck.id == deck_id, FlashcardDeck.student_id == session['user_id']).first()
+        if not deck:
+            return jsonify({'success': False, 'error': 'Deck not found'}), 404
+        cards = db.query(Flashcard).filter(Flashcard.deck_id == deck.id).order_by(Flashcard.id).all()
+        return jsonify({'success': True, 'deck': {'id': deck.id, 'topic': deck.topic},
+                        'flashcards': [format_flashcard(c) for c in cards]})
+    finally:
+        db.close()
+
+@bp.route('/api/flashcards/due', methods=['GET'])
+def get_due_flashcards():
+    """Cards due for review now, soonest first (served from the (student_id, due_at) index)"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    db = SessionLocal()
+    try:
+        cards = db.query(Flashcard).filter(Flashcard.student_id == session['user_id'], Flashcard.due_at <= datetime.utcnow())\
+            .order_by(Flashcard.due_at).limit(limit).all()
+        return jsonify({'success': True, 'flashcards': [format_flashcard(c) for c in cards]})
+    finally:
+        db.close()
+
+@bp.route('/api/flashcards/<int:card_id>/review', methods=['POST'])
+def review_flashcard(card_id):
+    """Grade a card 0-5 and schedule its next review"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    data = request.get_json()
+    quality = data.get('quality')
+    if quality not in [0, 1, 2, 3, 4, 5]:
+        return jsonify({'success': False, 'error': 'Quality must be an integer from 0 to 5'}), 400
+    
+    db = SessionLocal()
+    try:
+        card = db.query(Flashcard).filter(Flashcard.id == card_id, Flashcard.student_id == session['user_id']).first()
+        if not card:
+            return jsonify({'success': False, 'error': 'Flashcard not found'}), 404
+        
+        now = datetime.utcnow()
+        card.easiness, card.interval_days, card.repetitions = sm2_review(
+            card.easiness or 2.5, card.interval_days or 0, card.repetitions or 0, quality)
+        card.due_at = now + timedelta(days=card.interval_days)
+        card.last_reviewed_at = now
+        db.commit()
+        return jsonify({'success': True, 'flashcard': format_flashcard(card)})
+    finally:
+        db.close()
+
+# ============================================================================
+# TEACHER ANALYTICS ROLLUPS
+# ============================================================================
+# Writes to doubts and quiz sessions mark the affected days dirty in the same
+# transaction; a deduplicated background job then recomputes just those days.
+# Analytics endpoints only ever read the rollup tables.
+_rollup_scheduled_at = 0.0
+
+def _event_day(value):
+    return value.date() if value else None
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _mark_analytics_days(db, flush_context):
+    days = set()
+    for obj in list(db.new) + list(db.dirty):
+        if isinstance(obj, Doubt):
+            days.update([_event_day(obj.created_at), _event_day(obj.answered_at)])
+        elif isinstance(obj, QnASession):
+            days.add(_event_day(obj.created_at))
+    days.discard(None)
+    if days:
+        db.connection().execute(sqlite_insert(AnalyticsDirtyDay).on_conflict_do_nothing(),
+                                [{'day': day} for day in days])
+        db.info['analytics_dirty'] = True
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _schedule_analytics_rollup(db):
+    if db.info.pop('analytics_dirty', False):
+        schedule_rollup_refresh()
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def _discard_analytics_marks(db):
+    db.info.pop('analytics_dirty', None)
+
+def schedule_rollup_refresh():
+    """Queue a rollup refresh, at most once per ANALYTICS_ROLLUP_DELAY_SECONDS from this process"""
+    global _rollup_scheduled_at
+    if time.time() - _rollup_scheduled_at < ANALYTICS_ROLLUP_DELAY_SECONDS:
+        return
+    _rollup_scheduled_at = time.time()
+    try:
+        enqueue_job('refresh_analytics_rollups', priority=-5, dedup_key='refresh_analytics_rollups',
+                    delay_seconds=ANALYTICS_ROLLUP_DELAY_SECONDS)
+    except Exception as e:
+        print(f"Error scheduling analytics rollup: {e}")
+
+def _group_rows(*columns):
+    """Vectorised GROUP BY: returns the distinct key tuples and each row's group number"""
+    import numpy as np
+
+    uniques, codes = zip(*(np.unique(column, return_inverse=True) for column in columns))
+    shape = [len(u) for u in uniques]
+    keys, groups = np.unique(np.ravel_multi_index(codes, shape), return_inverse=True)
+    values = [u.tolist() for u in uniques]  # Plain Python dates, strings and ints
+    parts = np.unravel_index(keys, shape)
+    return [tuple(v[p] for v, p in zip(values, key)) for key in zip(*parts)], groups
+
+def _day_filter(column, days):
+    if days is None:
+        return column.isnot(None)
+    return or_(*[and_(column >= day, column < day + timedelta(days=1)) for day in days])
+
+def _epoch_seconds(column):
+    # Let SQLite turn stored timestamps into numbers; building datetimes per row dominates a backfill
+    return (func.julianday(column) - 2440587.5) * 86400.0
+
+def _epoch_days(seconds):
+    import numpy as np
+
+    return np.floor(seconds / 86400).astype('int64').astype('datetime64[D]')
+
+def _topic_keys(topics):
+    """Normalise topic strings, calling flashcard_topic_key once per distinct topic"""
+    import numpy as np
+
+    distinct, index = np.unique(np.asarray(topics, dtype=object).astype(str), return_inverse=True)
+    return np.array([flashcard_topic_key(t) for t in distinct], dtype=object)[index]
+
+def compute_doubt_rollups(db, days=None):
+    """Aggregate doubts into daily (day, topic, teacher) rows for the given days, or all days"""
+    import numpy as np
+
+    # Archived doubts keep contributing to their days' rollups
+    rows = db.connection().execute(union_all(*[
+        select(_epoch_seconds(model.created_at), _epoch_seconds(model.answered_at), model.topic, model.teacher_id,
+               func.coalesce(model.final_rating, model.rating), model.points_awarded)
+        .where(or_(_day_filter(model.created_at, days), _day_filter(model.answered_at, days)))
+        for model in [Doubt, ArchivedDoubt]
+    ])).all()
+    if not rows:
+        return []
+    created_at, answered_at, topics, teacher_ids, ratings, points = zip(*rows)
+    created_at = np.array(created_at, dtype=float)
+    answered_at = np.array(answered_at, dtype=float)  # None becomes NaN
+    topic_keys = _topic_keys(topics)
+    teacher_ids = np.array([t or 0 for t in teacher_ids])
+    ratings = np.array([r or 0 for r in ratings])
+    points = np.array([p or 0 for p in points])
+
+    asked = ~np.isnan(created_at)
+    answered = ~np.isnan(answered_at)
+    created_day = _epoch_days(np.where(asked, created_at, 0))
+    answered_day = _epoch_days(np.where(answered, answered_at, 0))
+    if days is not None:
+        wanted = np.array(sorted(days), dtype='datetime64[D]')
+        asked &= np.isin(created_day, wanted)
+        answered &= np.isin(answered_day, wanted)
+
+    # Each doubt contributes an "asked" event and, once answered, an "answered" event
+    n_asked, n_answered = int(asked.sum()), int(answered.sum())
+    is_answer = np.concatenate([np.zeros(n_asked, dtype=bool), np.ones(n_answered, dtype=bool)])
+    day = np.concatenate([created_day[asked], answered_day[answered]])
+    keys, groups = _group_rows(day, np.concatenate([topic_keys[asked], topic_keys[answered]]),
+                               np.concatenate([teacher_ids[asked], teacher_ids[answered]]))
+
+    def total(values):
+        return np.bincount(groups, np.concatenate([np.zeros(n_asked), values]), len(keys))
+
+    turnaround = answered_at[answered] - created_at[answered]
+    answer_ratings = ratings[answered]
+    sums = {
+        'asked': np.bincount(groups, ~is_answer, len(keys)),
+        'answered': np.bincount(groups, is_answer, len(keys)),
+        'turnaround_seconds': total(turnaround),
+        'rated': total(answer_ratings > 0),
+        'points_awarded': total(points[answered]),
+    }
+    for star in range(1, 6):
+        sums[f'rating_{star}'] = total(answer_ratings == star)
+    return [dict({'day': k[0], 'topic_key': k[1], 'teacher_id': int(k[2])},
+                 **{name: (float(v[g]) if name == 'turnaround_seconds' else int(v[g])) for name, v in sums.items()})
+            for g, k in enumerate(keys)]
+
+def compute_quiz_rollups(db, days=None):
+    """Aggregate completed quiz sessions into daily (day, topic) rows for the given days, or all days"""
+    import numpy as np
+
+    rows = db.connection().execute(
+        select(_epoch_seconds(QnASession.created_at), QnASession.topic, QnASession.correct_answers, QnASession.points_earned,
+               func.coalesce(func.json_array_length(QnASession.item_ids), 0))
+        .where(QnASession.completed == True, _day_filter(QnASession.created_at, days))
+    ).all()
+    if not rows:
+        return []
+    created_at, topics, correct, points, questions = zip(*rows)
+    keys, groups = _group_rows(_epoch_days(np.array(created_at, dtype=float)), _topic_keys(topics))
+    sums = {
+        'sessions': np.bincount(groups, minlength=len(keys)),
+        'questions': np.bincount(groups, np.array(questions, dtype=float), len(keys)),
+        'correct': np.bincount(groups, np.array([c or 0 for c in correct], dtype=float), len(keys)),
+        'points_earned': np.bincount(groups, np.array([p or 0 for p in points], dtype=float), len(keys)),
+    }
+    return [dict({'day': k[0], 'topic_key': k[1]}, **{name: int(v[g]) for name, v in sums.items()})
+            for g, k in enumerate(keys)]
+
+def write_rollups(db, days=None):
+    """Replace the rollup rows for the given days (or every day) with freshly computed ones"""
+    doubt_rows = compute_doubt_rollups(db, days)
+    quiz_rows = compute_quiz_rollups(db, days)
+    for model in [DoubtDailyRollup, QuizDailyRollup]:
+        query = db.query(model)
+        if days is not None:
+            query = query.filter(model.day.in_(days))
+        query.delete(synchronize_session=False)
+    if doubt_rows:
+        db.execute(sqlite_insert(DoubtDailyRollup), doubt_rows)
+    if quiz_rows:
+        db.execute(sqlite_insert(QuizDailyRollup), quiz_rows)
+    return len(doubt_rows) + len(quiz_rows)
+
+@job_handler('refresh_analytics_rollups')
+def refresh_analytics_rollups():
+    """Recompute the days marked dirty since the last refresh; returns the days refreshed"""
+    db = SessionLocal()
+    try:
+        # Taking the marks is the first write, so SQLite holds off new marks until we commit
+        days = sorted(row.day for row in db.execute(
+            AnalyticsDirtyDay.__table__.delete().returning(AnalyticsDirtyDay.day)))
+        if days:
+            write_rollups(db, days)
+        db.commit()
+        return [day.isoformat() for day in days]
+    finally:
+        db.close()
+
+@job_handler('backfill_analytics_rollups')
+def backfill_analytics_rollups():
+    """Rebuild every rollup from the raw tables"""
+    started = time.time()
+    db = SessionLocal()
+    try:
+        db.query(AnalyticsDirtyDay).delete(synchronize_session=False)
+        rows = write_rollups(db)
+        db.commit()
+        return {'rows': rows, 'seconds': round(time.time() - started, 3)}
+    finally:
+        db.close()
+
+def analytics_window():
+    """Parse the ?days= lookback (1-366, default 30) into a start date"""
+    try:
+        days = min(max(int(request.args.get('days', 30)), 1), 366)
+    except ValueError:
+        days = 30
+    return datetime.utcnow().date() - timedelta(days=days - 1)
+
+def kick_stale_rollups(db):
+    # Cover marks made while a refresh was already running (the dedup key suppresses a second job)
+    if db.query(AnalyticsDirtyDay.day).first() is not None:
+        schedule_rollup_refresh()
+
+@bp.route('/api/teacher/analytics/doubts', methods=['GET'])
+def get_doubt_analytics():
+    """Daily doubt volume, turnaround and ratings per topic, for the class or (?scope=me) this teacher"""
+    if 'user_id' not in session or session.get('user_role') != 'teacher':
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    db = SessionLocal()
+    try:
+        kick_stale_rollups(db)
+        r = DoubtDailyRollup
+        columns = [r.asked, r.answered, r.turnaround_seconds, r.rated, r.rating_1, r.rating_2,
+                   r.rating_3, r.rating_4, r.rating_5, r.points_awarded]
+        query = db.query(r.day, r.topic_key, *[func.sum(c) for c in columns]).filter(r.day >= analytics_window())
+        if request.args.get('scope') == 'me':
+            query = query.filter(r.teacher_id == session['user_id'])
+        if request.args.get('topic'):
+            query = query.filter(r.topic_key == flashcard_topic_key(request.args['topic']))
+        
+        series = []
+        for day, topic_key, asked, answered, turnaround, rated, *stars, points in query.group_by(r.day, r.topic_key).order_by(r.day, r.topic_key):
+            series.append({
+                'day': day.isoformat(),
+                'topic': topic_key,
+                'asked': asked,
+                'answered': answered,
+                'avg_turnaround_hours': round(turnaround / answered / 3600, 2) if answered else None,
+                'ratings': {str(star): count for star, count in enumerate(stars, start=1)},
+                'average_rating': round(sum(star * count for star, count in enumerate(stars, start=1)) / rated, 2) if rated else None,
+                'points_awarded': points
+            })
+        return jsonify({'success': True, 'series': series})
+    finally:
+        db.close()
+
+@bp.route('/api/teacher/analytics/quizzes', methods=['GET'])
+def get_quiz_analytics():
+    """Daily completed quizzes and average score per topic"""
+    if 'user_id' not in session or session.get('user_role') != 'teacher':
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    db = SessionLocal()
+    try:
+        kick_stale_rollups(db)
+        r = QuizDailyRollup
+        query = db.query(r).filter(r.day >= analytics_window())
+        if request.args.get('topic'):
+            query = query.filter(r.topic_key == flashcard_topic_key(request.args['topic']))
+        
+        return jsonify({'success': True, 'series': [{
+            'day': row.day.isoformat(),
+            'topic': row.topic_key,
+            'sessions': row.sessions,
+            'questions': row.questions,
+            'correct': row.correct,
+            'average_score': round(row.correct / row.questions * 100, 1) if row.questions else None,
+            'points_earned': row.points_earned
+        } for row in query.order_by(r.day, r.topic_key)]})
+    finally:
+        db.close()
+
+
+# ============================================================================
+# DOUBT ARCHIVAL & DATABASE MAINTENANCE
+# ============================================================================
+def archive_resolved_doubts(older_than_days=None, batch_size=None):
+    """Move resolved doubts answered more than older_than_days ago into doubts_archive; returns rows moved.
+
+    Works in small batches so the write lock is only ever held briefly.
+    """
+    older_than_days = DOUBT_ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    batch_size = batch_size or DOUBT_ARCHIVE_BATCH
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    columns = [c.name for c in Doubt.__table__.columns]
+    moved = 0
+    while True:
+        with engine.begin() as conn:
+            # SQLite hands out max(id) + 1 to the next row, so never move the newest doubt:
+            # a reused id would collide with its archived namesake
+            newest = conn.execute(select(func.max(Doubt.id))).scalar()
+            ids = conn.execute(
+                select(Doubt.id)
+                .where(Doubt.status == 'resolved', func.coalesce(Doubt.answered_at, Doubt.created_at) < cutoff,
+                       Doubt.id < newest)
+                .limit(batch_size)
+            ).scalars().all()
+            if not ids:
+                return moved
+            conn.execute(insert(ArchivedDoubt).from_select(
+                columns + ['archived_at'],
+                select(*[Doubt.__table__.c[name] for name in columns], literal(datetime.utcnow(), DateTime))
+                .where(Doubt.id.in_(ids))
+            ))
+            conn.execute(DoubtLease.__table__.delete().where(DoubtLease.doubt_id.in_(ids)))
+            conn.execute(DoubtDraft.__table__.delete().where(DoubtDraft.doubt_id.in_(ids)))
+            conn.execute(Doubt.__table__.delete().where(Doubt.id.in_(ids)))
+        moved += len(ids)
+
+def compact_database(pages=None):
+    """Release up to pages free pages back to the filesystem and refresh planner statistics"""
+    pages = pages or DB_VACUUM_PAGES
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+            # Incremental vacuum has to be switched on with one full rebuild of the file
+            conn.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.exec_driver_sql('VACUUM')
+        free_before = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+        # The pragma frees one page per step and execute() only steps once; executescript runs it to the end
+        conn.connection.dbapi_connection.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+        free_after = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+        # A bounded ANALYZE samples each index instead of reading it end to end
+        conn.exec_driver_sql('PRAGMA analysis_limit = 1000')
+        conn.exec_driver_sql('ANALYZE')
+    return {'pages_released': free_before - free_after, 'free_pages': free_after}
+
+@job_handler('maintain_database')
+def maintain_database():
+    """Periodic upkeep: archive old resolved doubts, then compact the file"""
+    archived = archive_resolved_doubts()
+    stats = compact_database()
+    stats['doubts_archived'] = archived
+    return stats
+
+
+# ============================================================================
+# BULK EXPORT & ROSTER IMPORT
+# ============================================================================
+# Exports walk each table in id order one page at a time on a short-lived
+# connection, so memory stays flat however large the table is, and a slow
+# download never holds SQLite's read lock (which would stall every writer).
+EXPORT_TABLES = {
+    'profiles': [Profile],
+    'doubts': [ArchivedDoubt, Doubt],  # Archived doubts hold the oldest ids
+    'learning-topics': [LearningTopic],
+    'points': [PointsTransaction],
+}
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_HIDDEN_COLUMNS = {'password_hash', 'idempotency_key', 'content_hash'}
+ROSTER_ROLES = ['student', 'teacher']
+ROSTER_MAX_ERRORS = 100  # Errors reported back; the rest are only counted as skipped
+
+def export_columns(name):
+    columns = []
+    for model in EXPORT_TABLES[name]:
+        columns += [c.name for c in model.__table__.columns
+                    if c.name not in columns and c.name not in EXPORT_HIDDEN_COLUMNS]
+    return columns
+
+def iter_export_pages(name, since=None, batch_size=None):
+    """Yield pages of rows (in export_columns order) for an export, oldest id first"""
+    batch_size = batch_size or EXPORT_BATCH_ROWS
+    columns = export_columns(name)
+    for model in EXPORT_TABLES[name]:
+        table = model.__table__
+        stmt = select(*[table.c[c] if c in table.c else literal(None).label(c) for c in columns])
+        if since:
+            stmt = stmt.where(table.c.created_at >= since)
+        last_id = 0
+        while True:
+            with engine.connect() as conn:
+                rows = conn.execute(stmt.where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)).all()
+            if rows:
+                yield rows
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1].id
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def render_export(name, fmt='ndjson', since=None):
+    """Yield an export as text, one chunk per page"""
+    columns = export_columns(name)
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        for rows in iter_export_pages(name, since):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows([_export_value(value) for value in row] for row in rows)
+            yield buffer.getvalue()
+    else:
+        for rows in iter_export_pages(name, since):
+            yield ''.join(json.dumps(dict(zip(columns, map(_export_value, row)))) + '\n' for row in rows)
+
+@bp.route('/api/admin/export/<name>', methods=['GET'])
+def export_table(name):
+    """Stream profiles, doubts, learning-topics or points as NDJSON (default) or ?format=csv; ?since=YYYY-MM-DD"""
+    if 'user_id' not in session or session.get('user_role') not in ['teacher', 'admin']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    if name not in EXPORT_TABLES:
+        return jsonify({'success': False, 'error': f'Unknown export; choose one of {", ".join(EXPORT_TABLES)}'}), 404
+    
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'error': 'format must be ndjson or csv'}), 400
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.strptime(since, '%Y-%m-%d')
+        except ValueError:
+            return jsonify({'success': False, 'error': 'since must be a YYYY-MM-DD date'}), 400
+    
+    filename = f"{name}-{datetime.utcnow():%Y%m%d}.{fmt}"
+    return Response(render_export(name, fmt, since), mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def _roster_entries(rows, stats, first_line):
+    """Normalise roster rows, counting and reporting the ones that can't become accounts"""
+    for line, row in enumerate(rows, start=first_line):
+        row = {str(key or '').strip().lower(): str(value or '').strip() for key, value in row.items()}
+        entry = {'line': line, 'email': row.get('email', ''), 'name': row.get('name', ''),
+                 'password': row.get('password', ''), 'role': row.get('role') or 'student',
+                 'grade': row.get('grade') or None, 'subject': row.get('subject') or None}
+        if not entry['email'] or '@' not in entry['email'] or not entry['name'] or not entry['password']:
+            _roster_error(stats, entry, 'email, name and password are required')
+        elif entry['role'] not in ROSTER_ROLES:
+            _roster_error(stats, entry, f"role must be one of {', '.join(ROSTER_ROLES)}")
+        else:
+            yield entry
+
+def _roster_error(stats, entry, error):
+    stats['skipped'] += 1
+    if len(stats['errors']) < ROSTER_MAX_ERRORS:
+        stats['errors'].append({'line': entry['line'], 'email': entry['email'], 'error': error})
+
+def _import_roster_batch(pool, batch, stats):
+    entries = {}
+    for entry in batch:
+        if entry['email'] in entries:
+            _roster_error(stats, entry, 'Email appears twice in the roster')
+        else:
+            entries[entry['email']] = entry
+    with engine.connect() as conn:
+        existing = conn.execute(select(Profile.email).where(Profile.email.in_(list(entries)))).scalars().all()
+    for email in existing:
+        _roster_error(stats, entries.pop(email), 'Email already exists')
+    if not entries:
+        return
+    
+    entries = list(entries.values())
+    hashes = pool.map(generate_password_hash, [entry['password'] for entry in entries], chunksize=8)
+    rows = [{'email': entry['email'], 'name': entry['name'], 'password_hash': password_hash, 'role': entry['role'],
+             'grade': entry['grade'], 'subject': entry['subject']}
+            for entry, password_hash in zip(entries, hashes)]
+    with engine.begin() as conn:
+        created = conn.execute(
+            sqlite_insert(Profile).on_conflict_do_nothing(index_elements=['email'])
+            .returning(Profile.id, Profile.email, Profile.role, Profile.grade, Profile.subject, Profile.name),
+            rows
+        ).all()
+    stats['created'] += len(created)
+    
+    created_emails = {row.email for row in created}
+    for entry in entries:
+        if entry['email'] not in created_emails:  # Signed up while this batch was hashing
+            _roster_error(stats, entry, 'Email already exists')
+    if leaderboards.built_at is not None:
+        for row in created:
+            leaderboards.apply(row.id, 0, row.role, row.grade, row.subject, row.name)
+
+def import_roster(rows, batch_size=None, workers=None, first_line=2):
+    """Create accounts from roster rows (email, name, password, optional role, grade and subject).
+
+    Password hashing is deliberately slow, so it runs in a process pool; each batch
+    of accounts is then inserted in one transaction. Existing emails are skipped.
+    Errors name the row by line number, counting the CSV header as line 1.
+    """
+    started = time.perf_counter()
+    batch_size = batch_size or ROSTER_IMPORT_BATCH
+    stats = {'created': 0, 'skipped': 0, 'errors': []}
+    entries = _roster_entries(rows, stats, first_line)
+    # forkserver: forking a process that already runs worker threads can deadlock the child
+    with ProcessPoolExecutor(max_workers=workers or ROSTER_HASH_WORKERS,
+                             mp_context=multiprocessing.get_context('forkserver')) as pool:
+        while True:
+            batch = [entry for _, entry in zip(range(batch_size), entries)]
+            if not batch:
+                break
+            _import_roster_batch(pool, batch, stats)
+    stats['seconds'] = round(time.perf_counter() - started, 2)
+    return stats
+
+@bp.route('/api/admin/roster', methods=['POST'])
+def import_roster_route():
+    """Bulk-create accounts from an uploaded CSV (`file`) or a JSON body {"users": [...]}"""
+    if 'user_id' not in session or session.get('user_role') not in ['teacher', 'admin']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    upload = request.files.get('file')
+    first_line = 2
+    if upload:
+        rows = csv.DictReader(io.TextIOWrapper(upload.stream, encoding='utf-8-sig'))
+    else:
+        first_line = 1  # JSON rows have no header line
+        rows = (request.get_json(silent=True) or {}).get('users')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return jsonify({'success': False, 'error': 'Upload a CSV file or send {"users": [...]}'}), 400
+    
+    try:
+        stats = import_roster(rows, first_line=first_line)
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'success': False, 'error': f'Could not read the roster: {e}'}), 400
+    return jsonify({'success': True, **stats})
+
+
+# ============================================================================
+# LEADERBOARDS
+# ============================================================================
+LEADERBOARD_REFRESH_SECONDS = int(os.getenv('LEADERBOARD_REFRESH_SECONDS', 300))  # Resync with the DB (other workers' writes)
+
+class _RankNode:
+    __slots__ = ('key', 'priority', 'size', 'left', 'right')
+
+    def __init__(self, key):
+        self.key = key
+        self.priority = random.random()
+        self.size = 1
+        self.left = None
+        self.right = None
+
+def _node_size(node):
+    return node.size if node else 0
+
+def _resize(node):
+    node.size = 1 + _node_size(node.left) + _node_size(node.right)
+
+def _treap_split(node, key):
+    """Split a treap into (keys < key, keys >= key)"""
+    if node is None:
+        return None, None
+    if node.key < key:
+        node.right, right = _treap_split(node.right, key)
+        _resize(node)
+        return node, right
+    left, node.left = _treap_split(node.left, key)
+    _resize(node)
+    return left, node
+
+def _treap_merge(left, right):
+    """Merge two treaps where every key in left is smaller than every key in right"""
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = _treap_merge(left.right, right)
+        _resize(left)
+        return left
+    right.left = _treap_merge(left, right.left)
+    _resize(right)
+    return right
+
+def _treap_remove(node, key):
+    if node is None:
+        return None
+    if key == node.key:
+        return _treap_merge(node.left, node.right)
+    if key < node.key:
+        node.left = _treap_remove(node.left, key)
+    else:
+        node.right = _treap_remove(node.right, key)
+    _resize(node)
+    return node
+
+class OrderStatisticTree:
+    """Treap of unique sortable keys with subtree sizes, so insert, remove and rank are O(log n)"""
+
+    def __init__(self):
+        self.root = None
+
+    def __len__(self):
+        return _node_size(self.root)
+
+    @classmethod
+    def from_sorted(cls, keys):
+        """Build a balanced tree from sorted keys without n separate inserts"""
+        def build(lo, hi):
+            if lo >= hi:
+                return None
+            mid = (lo + hi) // 2
+            node = _RankNode(keys[mid])
+            node.left = build(lo, mid)
+            node.right = build(mid + 1, hi)
+            node.size = hi - lo
+            return node
+
+        tree = cls()
+        tree.root = build(0, len(keys))
+        # Hand out priorities level by level so every parent outranks its children
+        priorities = iter(sorted((random.random() for _ in keys), reverse=True))
+        level = [tree.root] if tree.root else []
+        while level:
+            next_level = []
+            for node in level:
+                node.priority = next(priorities)
+                next_level.extend(child for child in (node.left, node.right) if child)
+            level = next_level
+        return tree
+
+    def insert(self, key):
+        left, right = _treap_split(self.root, key)
+        self.root = _treap_merge(_treap_merge(left, _RankNode(key)), right)
+
+    def remove(self, key):
+        self.root = _treap_remove(self.root, key)
+
+    def rank(self, key):
+        """Number of keys strictly smaller than key"""
+        node, smaller = self.root, 0
+        while node:
+            if node.key < key:
+                smaller += _node_size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return smaller
+
+    def smallest(self, count):
+        """The first count keys in order, in O(log n + count)"""
+        keys, stack, node = [], [], self.root
+        while (stack or node) and len(keys) < count:
+            if node:
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                keys.append(node.key)
+                node = node.right
+        return keys
+
+class LeaderboardRegistry:
+    """In-memory global, per-grade and per-subject leaderboards, kept separately for each role.
+
+    Boards are keyed by (role, scope, value), where scope is 'global', 'grade' or
+    'subject'. Entries are ordered by (-points, user_id), so rank 1 has the most
+    points and ties go to the earlier account.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.boards = {}
+        self.members = {}  # user_id -> (points, role, grade, subject, name)
+        self.built_at = None
+
+    def _board_keys(self, member):
+        points, role, grade, subject, name = member
+        keys = [(role, 'global', None)]
+        if grade:
+            keys.append((role, 'grade', grade))
+        if subject:
+            keys.append((role, 'subject', subject))
+        return keys
+
+    def _remove(self, user_id):
+        member = self.members.pop(user_id, None)
+        if member:
+            for board_key in self._board_keys(member):
+                self.boards[board_key].remove((-member[0], user_id))
+
+    def apply(self, user_id, points, role, grade, subject, name):
+        """Insert or move one user on every board they belong to"""
+        member = (points or 0, role, grade, subject, name)
+        with self.lock:
+            if self.members.get(user_id) == member:
+                return
+            self._remove(user_id)
+            self.members[user_id] = member
+            for board_key in self._board_keys(member):
+                self.boards.setdefault(board_key, OrderStatisticTree()).insert((-member[0], user_id))
+
+    def discard(self, user_id):
+        with self.lock:
+            self._remove(user_id)
+
+    def rebuild(self, rows):
+        """Replace every board from (id, points, role, grade, subject, name) rows"""
+        members, grouped = {}, {}
+        for user_id, points, role, grade, subject, name in rows:
+            member = (points or 0, role, grade, subject, name)
+            members[user_id] = member
+            for board_key in self._board_keys(member):
+                grouped.setdefault(board_key, []).append((-member[0], user_id))
+        boards = {board_key: OrderStatisticTree.from_sorted(sorted(keys)) for board_key, keys in grouped.items()}
+        with self.lock:
+            self.boards, self.members = boards, members
+            self.built_at = time.time()
+
+    def top(self, board_key, count):
+        with self.lock:
+            board = self.boards.get(board_key)
+            if not board:
+                return []
+            return [(user_id, -neg_points, self.members[user_id][4]) for neg_points, user_id in board.smallest(count)]
+
+    def rank(self, board_key, user_id):
+        """1-based rank of a user on a board, or None if they are not on it"""
+        with self.lock:
+            member = self.members.get(user_id)
+            board = self.boards.get(board_key)
+            if not member or not board or board_key not in self._board_keys(member):
+                return None
+            return board.rank((-member[0], user_id)) + 1
+
+    def size(self, board_key):
+        with self.lock:
+            board = self.boards.get(board_key)
+            return len(board) if board else 0
+
+leaderboards = LeaderboardRegistry()
+
+def rebuild_leaderboards():
+    """Reload every leaderboard from the profiles table (startup and recovery path)"""
+    db = SessionLocal()
+    try:
+        rows = db.query(Profile.id, Profile.points, Profile.role, Profile.grade, Profile.subject, Profile.name).all()
+        leaderboards.rebuild(rows)
+    finally:
+        db.close()
+
+def ensure_leaderboards():
+    if leaderboards.built_at is None or time.time() - leaderboards.built_at > LEADERBOARD_REFRESH_SECONDS:
+        rebuild_leaderboards()
+
+def track_leaderboard_change(db, profile):
+    """Queue a profile's board position to be updated when db commits"""
+    db.info.setdefault('leaderboard_changes', {})[profile.id] = (
+        profile.id, profile.points, profile.role, profile.grade, profile.subject, profile.name)
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _collect_leaderboard_changes(db, flush_context):
+    """Remember profiles written in this transaction so their ranks move on commit"""
+    for obj in list(db.new) + list(db.dirty):
+        if isinstance(obj, Profile):
+            track_leaderboard_change(db, obj)
+    for obj in db.deleted:
+        if isinstance(obj, Profile):
+            db.info.setdefault('leaderboard_changes', {})[obj.id] = None
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _apply_leaderboard_changes(db):
+    pending = db.info.pop('leaderboard_changes', None)
+    if not pending or leaderboards.built_at is None:
+        return
+    for user_id, row in pending.items():
+        if row is None:
+            leaderboards.discard(user_id)
+        else:
+            leaderboards.apply(*row)
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def _discard_leaderboard_changes(db):
+    db.info.pop('leaderboard_changes', None)
+
+@bp.route('/api/leaderboard', methods=['GET'])
+def get_leaderboard():
+    """Top players and the caller's rank on the global, grade or subject board"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    scope = request.args.get('scope', 'global')
+    if scope not in ['global', 'grade', 'subject']:
+        return jsonify({'success': False, 'error': 'Scope must be global, grade or subject'}), 400
+    limit = max(1, min(request.args.get('limit', 50, type=int), 100))
+
+    user = get_user_by_id(session['user_id'])
+    if not user:
+        return jsonify({'success': False, 'error': 'User not found'}), 404
+    role = request.args.get('role', user.role)
+    value = None
+    if scope != 'global':
+        value = request.args.get('value') or getattr(user, scope)
+        if not value:
+            return jsonify({'success': False, 'error': f'No {scope} given and none set on your profile'}), 400
+
+    ensure_leaderboards()
+    board_key = (role, scope, value)
+    top = leaderboards.top(board_key, limit)
+    return jsonify({
+        'success': True,
+        'scope': scope,
+        'value': value,
+        'role': role,
+        'total': leaderboards.size(board_key),
+        'leaderboard': [{'rank': i + 1, 'user_id': user_id, 'name': name, 'points': points}
+                        for i, (user_id, points, name) in enumerate(top)],
+        'my_rank': leaderboards.rank(board_key, user.id),
+        'my_points': user.points or 0
+    })
+
+@bp.route('/api/leaderboard/rebuild', methods=['POST'])
+def rebuild_leaderboard_route():
+    """Force a reload of the leaderboards from the database"""
+    if 'user_id' not in session or session.get('user_role') not in ['teacher', 'admin']:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    rebuild_leaderboards()
+    return jsonify({'success': True, 'members': len(leaderboards.members)})
+
+# ============================================================================
+# SCHEMA MIGRATIONS
+# ============================================================================
+MIGRATIONS = []
+
+def migration(version, description):
+    """Register a schema migration; migrations run once each, in version order"""
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+def add_missing_columns(conn, table, columns):
+    """ALTER TABLE ADD COLUMN for each (name, ddl) pair the table doesn't have yet"""
+    existing = {c['name'] for c in inspect(conn).get_columns(table)}
+    for name, ddl in columns:
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+@migration(1, 'Create missing tables')
+def _migrate_create_tables(conn):
+    Base.metadata.create_all(bind=conn)
+
+@migration(2, 'Add activity counters and doubt feedback columns to databases created before them')
+def _migrate_feedback_columns(conn):
+    add_missing_columns(conn, 'profiles', [
+        ('doubts_asked', 'INTEGER DEFAULT 0'),
+        ('qna_sessions', 'INTEGER DEFAULT 0'),
+    ])
+    add_missing_columns(conn, 'doubts', [
+        ('question_image', 'VARCHAR'),
+        ('answer_image', 'VARCHAR'),
+        ('rating', 'INTEGER'),
+        ('upvoted', 'BOOLEAN DEFAULT 0'),
+        ('downvoted', 'BOOLEAN DEFAULT 0'),
+        ('student_comment', 'TEXT'),
+        ('teacher_reply', 'TEXT'),
+        ('final_rating', 'INTEGER'),
+        ('final_upvoted', 'BOOLEAN DEFAULT 0'),
+        ('points_awarded', 'INTEGER DEFAULT 0'),
+    ])
+
+@migration(3, 'Add flashcard decks and spaced-repetition schedule')
+def _migrate_flashcard_decks(conn):
+    Base.metadata.create_all(bind=conn, tables=[FlashcardDeck.__table__, Flashcard.__table__])
+
+@migration(4, 'Add adaptive quiz items, topic mastery and answer history')
+def _migrate_adaptive_quiz(conn):
+    Base.metadata.create_all(bind=conn, tables=[QuizItem.__table__, TopicMastery.__table__, QuizAnswer.__table__])
+    add_missing_columns(conn, 'qna_sessions', [('item_ids', 'TEXT')])
+
+@migration(5, 'Add teacher analytics rollups and event-time indexes')
+def _migrate_analytics_rollups(conn):
+    Base.metadata.create_all(bind=conn, tables=[DoubtDailyRollup.__table__, QuizDailyRollup.__table__,
+                                                 AnalyticsDirtyDay.__table__])
+    # Only this version's indexes: later ones need columns that later migrations add
+    for table in [Doubt.__table__, QnASession.__table__]:
+        for index in table.indexes:
+            if index.name in ['ix_doubts_created_at', 'ix_doubts_answered_at', 'ix_qna_sessions_created_at']:
+                index.create(conn, checkfirst=True)
+
+@migration(6, 'Add the resolved doubts archive')
+def _migrate_doubt_archive(conn):
+    Base.metadata.create_all(bind=conn, tables=[ArchivedDoubt.__table__])
+
+@migration(7, 'Add AI rate limit buckets, role quotas and token usage accounting')
+def _migrate_ai_quotas(conn):
+    Base.metadata.create_all(bind=conn, tables=[RateBucket.__table__, RoleQuota.__table__, AIUsage.__table__])
+
+@migration(8, 'Add AI draft answers for doubts')
+def _migrate_doubt_drafts(conn):
+    Base.metadata.create_all(bind=conn, tables=[DoubtDraft.__table__, DraftCache.__table__])
+
+@migration(9, 'Add doubt idempotency keys, content hashes and per-student/teacher indexes')
+def _migrate_doubt_dedup(conn):
+    for table in ['doubts', 'doubts_archive']:
+        add_missing_columns(conn, table, [('idempotency_key', 'VARCHAR'), ('content_hash', 'VARCHAR')])
+    for table in [Doubt.__table__, ArchivedDoubt.__table__]:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    # Superseded by ix_doubts_archive_student_created and ix_doubts_archive_teacher_status
+    conn.execute(text("DROP INDEX IF EXISTS ix_doubts_archive_student_id"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_doubts_archive_teacher_id"))
+
+def run_migrations(bind=None):
+    """Apply pending migrations, each in its own transaction; returns the versions applied"""
+    bind = bind or engine
+    with bind.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, description VARCHAR NOT NULL, applied_at DATETIME NOT NULL)"
+        ))
+        applied = {v for (v,) in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    done = []
+    for version, description, fn in MIGRATIONS:
+        if version in applied:
+            continue
+        with bind.begin() as conn:
+            fn(conn)
+            conn.execute(text("INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)"),
+                         {'v': version, 'd': description, 't': datetime.utcnow()})
+        done.append(version)
+    return done
+
+# ============================================================================
+# APP FACTORY & CLI
+# ============================================================================
+def create_app(config=None):
+    """Build and configure the Flask app.
+
+    Schema changes are not applied here; run `flask --app app db-upgrade` (or set
+    AUTO_MIGRATE=1) so that worker boots and test imports stay cheap.
+    """
+    from dotenv import load_dotenv
+    from flask_cors import CORS
+
+    load_dotenv()
+    load_settings()
+
+    app = Flask(__name__, static_folder='static')
+    app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-here')
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    app.config['DATABASE_URL'] = DATABASE_URL
+    app.config['AUTO_MIGRATE'] = os.getenv('AUTO_MIGRATE') == '1'
+    if config:
+        app.config.update(config)
+    CORS(app)
+
+    init_engine(app.config['DATABASE_URL'])
+    if app.config['AUTO_MIGRATE']:
+        run_migrations()
+
+    # Create uploads directory if it doesn't exist
+    for folder in ['questions', 'answers']:
+        os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], folder), exist_ok=True)
+
+    app.register_blueprint(bp)
+    app.cli.add_command(db_upgrade_command)
+    app.cli.add_command(run_worker_command)
+    app.cli.add_command(recalibrate_mastery_command)
+    app.cli.add_command(rollup_analytics_command)
+    app.cli.add_command(maintain_db_command)
+    app.cli.add_command(export_data_command)
+    app.cli.add_command(import_roster_command)
+    return app
+
+@click.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations."""
+    applied = run_migrations()
+    click.echo(f"Applied migrations: {applied}" if applied else "Database is up to date.")
+
+@click.command('run-worker')
+@click.option('--workers', type=int, default=None, help='Worker count (defaults to JOB_WORKERS).')
+@click.option('--mode', type=click.Choice(['thread', 'process']), default=None, help='Run handlers in threads or processes.')
+def run_worker_command(workers, mode):
+    """Run a dedicated background job worker until interrupted."""
+    pool = JobWorkerPool(workers=workers or max(JOB_WORKERS, 1), mode=mode)
+    pool.start()
+    click.echo(f"Job worker running with {len(pool.threads)} {pool.mode} workers. Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop()
+
+@click.command('recalibrate-mastery')
+@click.option('--iterations', type=int, default=30, help='Newton iterations over the answer history.')
+@click.option('--enqueue', is_flag=True, help='Queue the refit for the job workers instead of running it here.')
+def recalibrate_mastery_command(iterations, enqueue):
+    """Refit quiz mastery and question ratings from the full answer history."""
+    if enqueue:
+        job_id = enqueue_job('recalibrate_mastery', {'iterations': iterations}, dedup_key='recalibrate_mastery')
+        click.echo(f"Queued recalibration job {job_id}.")
+        return
+    stats = recalibrate_mastery(iterations=iterations)
+    click.echo(f"Refit {stats['students']} student-topic and {stats['items']} item ratings "
+               f"from {stats['answers']} answers in {stats['seconds']}s.")
+
+@click.command('rollup-analytics')
+@click.option('--backfill', is_flag=True, help='Rebuild every day from the raw tables instead of just the dirty ones.')
+def rollup_analytics_command(backfill):
+    """Refresh the teacher analytics rollups."""
+    if backfill:
+        stats = backfill_analytics_rollups()
+        click.echo(f"Rebuilt {stats['rows']} rollup rows in {stats['seconds']}s.")
+    else:
+        days = refresh_analytics_rollups()
+        click.echo(f"Refreshed {len(days)} days." if days else "Rollups are up to date.")
+
+@click.command('maintain-db')
+@click.option('--older-than-days', type=int, default=None, help='Archive resolved doubts older than this (defaults to DOUBT_ARCHIVE_AFTER_DAYS).')
+@click.option('--pages', type=int, default=None, help='Free pages to release (defaults to DB_VACUUM_PAGES).')
+def maintain_db_command(older_than_days, pages):
+    """Archive old resolved doubts and compact the database."""
+    archived = archive_resolved_doubts(older_than_days)
+    stats = compact_database(pages)
+    click.echo(f"Archived {archived} doubts; released {stats['pages_released']} pages "
+               f"({stats['free_pages']} still free).")
+
+@click.command('export-data')
+@click.argument('name', type=click.Choice(list(EXPORT_TABLES)))
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='ndjson', help='Output format.')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='Only rows created on or after this date.')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='Destination file (stdout by default).')
+def export_data_command(name, fmt, since, output):
+    """Stream a table to a file as NDJSON or CSV."""
+    for chunk in render_export(name, fmt, since):
+        output.write(chunk)
+
+@click.command('import-roster')
+@click.argument('roster', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--batch-size', type=int, default=None, help='Accounts per transaction (defaults to ROSTER_IMPORT_BATCH).')
+@click.option('--workers', type=int, default=None, help='Password hashing processes (defaults to ROSTER_HASH_WORKERS).')
+def import_roster_command(roster, batch_size, workers):
+    """Create accounts from a CSV roster with email, name, password, role, grade and subject columns."""
+    stats = import_roster(csv.DictReader(roster), batch_size=batch_size, workers=workers)
+    click.echo(f"Created {stats['created']} accounts, skipped {stats['skipped']} in {stats['seconds']}s.")
+    for error in stats['errors']:
+        click.echo(f"  line {error['line']} ({error['email'] or 'no email'}): {error['error']}")
+
+_default_app = None
+
+def __getattr__(name):
+    # `gunicorn app:app` and `flask --app app` look up `app`; build it only when asked
+    global _default_app
+    if name == 'app':
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # ============================================================================
 # MAIN EXECUTION
 # ============================================================================
 if __name__ == '__main__':
+    app = create_app()
+    run_migrations()
     port = int(os.environ.get('PORT', 5000))
-    app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=port)
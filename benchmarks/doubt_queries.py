@@ -0,0 +1,140 @@
+"""Time the per-student and per-teacher doubt lookups on a large synthetic database.
+
+Usage:
+    python benchmarks/doubt_queries.py [--doubts 300000] [--students 5000] [--teachers 200]
+                                       [--samples 2000] [--max-ms 1.0] [--without-indexes]
+
+Builds a throwaway database with --doubts live doubts (plus a third as many
+archived ones), runs the migrations and ANALYZE (as `maintain-db` does), then
+times each query for random students/teachers and prints its plan. Latency is
+measured for the SQL alone (precompiled, straight through the sqlite3 driver)
+and for the helper the endpoint calls, which also builds ORM objects. With --max-ms the script exits non-zero when a median SQL
+time exceeds the budget; --without-indexes drops the per-student/teacher
+indexes first, for comparison.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+ACCESS_PATH_INDEXES = ['ix_doubts_student_created', 'ix_doubts_teacher_status', 'ix_doubts_status_created',
+                       'ix_doubts_archive_student_created', 'ix_doubts_archive_teacher_status']
+
+def populate(app, doubts, students, teachers):
+    now = datetime.utcnow()
+    statuses = ['pending', 'answered', 'resolved']
+    rows = []
+    for i in range(doubts + doubts // 3):
+        status = random.choices(statuses, weights=[1, 2, 7])[0]
+        created = now - timedelta(minutes=random.randint(0, 60 * 24 * 365))
+        rows.append({
+            'student_id': random.randint(1, students),
+            'teacher_id': None if status == 'pending' else students + random.randint(1, teachers),
+            'topic': random.choice(['Algebra', 'Calculus', 'Physics', 'Chemistry', 'Biology']),
+            'question': f"Synthetic question {i}",
+            'status': status,
+            'answer': None if status == 'pending' else f"Synthetic answer {i}",
+            'final_rating': random.randint(1, 5) if status == 'resolved' else None,
+            'points_awarded': 5 if status != 'pending' else 0,
+            'content_hash': f"{i:064x}",
+            'created_at': created,
+        })
+    live, archived = rows[:doubts], [dict(row, status='resolved', archived_at=now) for row in rows[doubts:]]
+    with app.engine.begin() as conn:
+        conn.execute(app.Doubt.__table__.insert(), live)
+        conn.execute(app.ArchivedDoubt.__table__.insert(), archived)
+        conn.exec_driver_sql('ANALYZE')
+
+def timed(fn, args_list):
+    samples = []
+    for args in args_list:
+        started = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - started) * 1000)
+    ordered = sorted(samples)
+    return statistics.median(ordered), ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--doubts', type=int, default=300000)
+    parser.add_argument('--students', type=int, default=5000)
+    parser.add_argument('--teachers', type=int, default=200)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--max-ms', type=float, default=None)
+    parser.add_argument('--without-indexes', action='store_true')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ.update(DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}", JOB_WORKERS='0')
+    import app
+    from sqlalchemy import func, select
+    app.load_settings()
+    app.init_engine()
+    app.run_migrations()
+
+    started = time.perf_counter()
+    populate(app, args.doubts, args.students, args.teachers)
+    print(f"Loaded {args.doubts} doubts and {args.doubts // 3} archived for {args.students} students "
+          f"in {time.perf_counter() - started:.1f}s")
+    if args.without_indexes:
+        with app.engine.begin() as conn:
+            for name in ACCESS_PATH_INDEXES:
+                conn.exec_driver_sql(f'DROP INDEX IF EXISTS {name}')
+            conn.exec_driver_sql('ANALYZE')
+        print("Dropped the per-student/teacher indexes")
+
+    Doubt, ArchivedDoubt = app.Doubt, app.ArchivedDoubt
+    student_ids = [(random.randint(1, args.students),) for _ in range(args.samples)]
+    teacher_ids = [(args.students + random.randint(1, args.teachers),) for _ in range(args.samples)]
+    # (name, sample arguments, the SQL statements the helper issues, the helper the endpoint calls)
+    queries = [
+        ('student doubt list', student_ids,
+         lambda sid: [select(Doubt).where(Doubt.student_id == sid).order_by(Doubt.created_at.desc()),
+                      select(ArchivedDoubt).where(ArchivedDoubt.student_id == sid).order_by(ArchivedDoubt.created_at.desc())],
+         app.list_student_doubts),
+        ('teacher stats', teacher_ids,
+         lambda tid: [select(func.count(model.id), func.sum(model.points_awarded), func.sum(model.final_rating),
+                             func.count(model.final_rating))
+                      .where(model.teacher_id == tid, model.status.in_(['answered', 'resolved']))
+                      for model in [Doubt, ArchivedDoubt]],
+         app.teacher_answer_stats),
+        ('duplicate submit check', student_ids,
+         lambda sid: [select(Doubt).where(Doubt.student_id == sid, Doubt.idempotency_key == 'retry'),
+                      select(Doubt).where(Doubt.student_id == sid, Doubt.status == 'pending', Doubt.content_hash == 'x')],
+         lambda db, sid: app.find_submitted_doubt(db, sid, 'retry', 'x')),
+        ('oldest pending (routing)', student_ids,
+         lambda sid: [select(func.min(Doubt.created_at)).where(Doubt.student_id == sid, Doubt.status == 'pending')],
+         None),
+    ]
+
+    failed = False
+    print(f"{'query':<26}{'sql p50':>10}{'sql p99':>10}{'helper p50':>12}{'helper p99':>12}   plan")
+    with app.engine.connect() as conn:
+        db = app.SessionLocal(bind=conn)
+        cursor = conn.connection.dbapi_connection.cursor()
+        for name, arg_list, statements, helper in queries:
+            compiled = [[str(stmt.compile(conn, compile_kwargs={'literal_binds': True})) for stmt in statements(*key)]
+                        for key in arg_list]
+            plans = [', '.join(row[-1] for row in cursor.execute(f'EXPLAIN QUERY PLAN {sql}')) for sql in compiled[0]]
+            sql_p50, sql_p99 = timed(lambda *sqls: [cursor.execute(sql).fetchall() for sql in sqls], compiled)
+            if helper:
+                helper_p50, helper_p99 = timed(lambda key: (helper(db, key), db.expunge_all()), arg_list)
+                helper_cols = f"{helper_p50:10.3f}ms{helper_p99:10.3f}ms"
+            else:
+                helper_cols = f"{'-':>12}{'-':>12}"
+            print(f"{name:<26}{sql_p50:8.3f}ms{sql_p99:8.3f}ms{helper_cols}   {' | '.join(plans)}")
+            failed |= args.max_ms is not None and sql_p50 > args.max_ms
+        db.close()
+    if failed:
+        print(f"Median SQL time exceeded the {args.max_ms} ms budget")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
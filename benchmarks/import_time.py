@@ -0,0 +1,73 @@
+"""Measure cold-start cost of the app: `import app` and `create_app()` in fresh interpreters.
+
+Usage:
+    python benchmarks/import_time.py [--runs 10] [--max-import-ms 800] [--json]
+
+Each run starts a new Python process so nothing is cached between samples.
+With --max-import-ms the script exits non-zero when the median import time
+exceeds the budget, so it can gate CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(imported - start, created - imported)
+"""
+
+def sample(workdir):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, JOB_WORKERS='0',
+               DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=workdir, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    import_s, factory_s = map(float, out.split())
+    return import_s * 1000, factory_s * 1000
+
+def summarize(values):
+    return {
+        'median_ms': round(statistics.median(values), 1),
+        'min_ms': round(min(values), 1),
+        'max_ms': round(max(values), 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-import-ms', type=float, default=None)
+    parser.add_argument('--json', action='store_true', help='Print one JSON object instead of a table')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        samples = [sample(workdir) for _ in range(args.runs)]
+
+    report = {
+        'runs': args.runs,
+        'import': summarize([s[0] for s in samples]),
+        'create_app': summarize([s[1] for s in samples]),
+    }
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for name in ['import', 'create_app']:
+            stats = report[name]
+            print(f"{name:<12} median {stats['median_ms']:>7.1f} ms   "
+                  f"min {stats['min_ms']:>7.1f} ms   max {stats['max_ms']:>7.1f} ms")
+
+    if args.max_import_ms is not None and report['import']['median_ms'] > args.max_import_ms:
+        print(f"Median import time exceeds budget of {args.max_import_ms} ms", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
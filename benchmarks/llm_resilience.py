@@ -0,0 +1,114 @@
+"""Exercise llm_chat() against the local stub server: tail latency with and without hedging, then an outage.
+
+Usage:
+    python benchmarks/llm_resilience.py [--calls 200] [--latency-ms 50] [--slow-rate 0.05] [--slow-ms 2000]
+
+Phase 1 sends the same calls straight to the client and through llm_chat() and
+compares latency percentiles. Phase 2 makes every stub request fail, checks that
+the circuit breaker opens and rejects calls without touching the network, and
+then that a probe closes it again once the stub recovers. Phase 3 does the same
+against a port nothing listens on (connection refused). The run exits non-zero
+when a failing call raises anything but LLMUnavailable, the breaker stays
+closed, or calls still reach the provider after the failure threshold.
+"""
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from llm_stub_server import start_stub_server  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "What is photosynthesis?"}]
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    pick = lambda pct: ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)] * 1000
+    return f"p50 {pick(50):7.1f} ms   p95 {pick(95):7.1f} ms   p99 {pick(99):7.1f} ms   max {ordered[-1] * 1000:7.1f} ms"
+
+def timed(fn, expected_error=None):
+    """(seconds, ok); only expected_error counts as a failed call, anything else propagates"""
+    started = time.perf_counter()
+    try:
+        fn()
+        ok = True
+    except Exception as e:
+        if expected_error is None or not isinstance(e, expected_error):
+            raise
+        ok = False
+    return time.perf_counter() - started, ok
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--slow-rate', type=float, default=0.05)
+    parser.add_argument('--slow-ms', type=float, default=2000)
+    args = parser.parse_args()
+
+    server, state = start_stub_server(latency_ms=args.latency_ms, slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    workdir = tempfile.mkdtemp()
+    os.environ.update(OPENAI_API_BASE=f"http://127.0.0.1:{server.server_address[1]}/v1", OPENAI_API_KEY='stub',
+                      DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}", JOB_WORKERS='0',
+                      LLM_BREAKER_COOLDOWN_SECONDS='1')
+    import app
+    app.load_settings()
+    app.get_openai().api_base = os.environ['OPENAI_API_BASE']
+
+    print(f"Tail latency over {args.calls} calls ({args.slow_rate:.0%} of requests take ~{args.slow_ms:.0f} ms)")
+    direct = [timed(lambda: app._call_llm(MESSAGES, {'model': 'stub'}))[0] for _ in range(args.calls)]
+    print(f"  direct     {percentiles(direct)}")
+    hedged = [timed(lambda: app.llm_chat('bench', MESSAGES, model='stub'))[0] for _ in range(args.calls)]
+    print(f"  llm_chat   {percentiles(hedged)}")
+    print(f"  hedges sent {app.llm_stats['hedges']}, won {app.llm_stats['hedge_wins']}")
+
+    problems = []
+    chat = lambda: app.llm_chat('bench', MESSAGES, model='stub')
+    threshold = app.LLM_BREAKER_FAILURES
+
+    print("Outage (every request fails)")
+    state.update({'error_rate': 1, 'slow_rate': 0})
+    results = [timed(chat, app.LLMUnavailable) for _ in range(threshold)]
+    served = state.snapshot()['requests']
+    results += [timed(chat, app.LLMUnavailable) for _ in range(20)]
+    reached = state.snapshot()['requests'] - served
+    print(f"  breaker {app.llm_breaker.state}; failed {sum(not ok for _, ok in results)}/{len(results)} calls, "
+          f"{reached} reached the provider after the first {threshold}, "
+          f"median fail-fast {statistics.median(t for t, _ in results[threshold:]) * 1000:.2f} ms")
+    if app.llm_breaker.state != 'open' or reached:
+        problems.append('breaker did not stop calls to a failing provider')
+
+    state.update({'error_rate': 0})
+    time.sleep(app.LLM_BREAKER_COOLDOWN_SECONDS)
+    _, ok = timed(chat, app.LLMUnavailable)
+    print(f"Recovery: probe {'succeeded' if ok else 'failed'}, breaker {app.llm_breaker.state}")
+    if not ok or app.llm_breaker.state != 'closed':
+        problems.append('breaker did not close after the provider recovered')
+
+    print("Provider unreachable (connection refused)")
+    app.get_openai().api_base = f"http://127.0.0.1:{closed_port()}/v1"
+    rejected = app.llm_stats['rejected']
+    results = [timed(chat, app.LLMUnavailable) for _ in range(threshold + 10)]
+    print(f"  breaker {app.llm_breaker.state}; failed {sum(not ok for _, ok in results)}/{len(results)} calls, "
+          f"{app.llm_stats['rejected'] - rejected} rejected without a request")
+    if any(ok for _, ok in results) or app.llm_breaker.state != 'open' or app.llm_stats['rejected'] - rejected < 10:
+        problems.append('refused connections did not open the breaker')
+    server.shutdown()
+
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    if problems:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
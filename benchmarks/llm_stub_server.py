@@ -0,0 +1,157 @@
+"""A local stand-in for the OpenAI chat completions API that injects latency and errors.
+
+Usage:
+    python benchmarks/llm_stub_server.py [--port 8765] [--latency-ms 80] [--slow-rate 0.05]
+                                         [--slow-ms 4000] [--error-rate 0.0]
+
+Point the app at it with:
+    OPENAI_API_BASE=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python app.py
+
+Every request sleeps about --latency-ms; a --slow-rate fraction sleeps --slow-ms
+instead (the tail that hedging targets) and an --error-rate fraction answers 500.
+Requests with "stream": true get server-sent event chunks, and requests that pass
+"functions" get a function call back, as the real API does.
+POST a JSON object with any of latency_ms, slow_rate, slow_ms, error_rate to
+/control to change the behaviour while the server runs, e.g. to simulate an outage:
+    curl -X POST localhost:8765/control -d '{"error_rate": 1}'
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FLASHCARDS = [
+    {"term": "Stub term", "definition": "A definition served by the stub server."},
+    {"term": "Second stub term", "definition": "Another definition served by the stub server."},
+]
+
+class StubState:
+    def __init__(self, latency_ms=80, slow_rate=0.05, slow_ms=4000, error_rate=0.0):
+        self.latency_ms = latency_ms
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.error_rate = error_rate
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def update(self, values):
+        with self.lock:
+            for name in ['latency_ms', 'slow_rate', 'slow_ms', 'error_rate']:
+                if name in values:
+                    setattr(self, name, float(values[name]))
+
+    def snapshot(self):
+        with self.lock:
+            return {'latency_ms': self.latency_ms, 'slow_rate': self.slow_rate, 'slow_ms': self.slow_ms,
+                    'error_rate': self.error_rate, 'requests': self.requests}
+
+def reply_for(body):
+    messages = body.get('messages', [])
+    if body.get('functions'):
+        return json.dumps({'flashcards': FLASHCARDS})
+    if any('JSON' in m.get('content', '') for m in messages if m.get('role') == 'system'):
+        return json.dumps(FLASHCARDS)
+    question = next((m['content'] for m in reversed(messages) if m.get('role') == 'user'), '')
+    return f"Stub reply to: {question[:200]}"
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._send(200, state.snapshot())
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path.rstrip('/') == '/control':
+                state.update(body)
+                return self._send(200, state.snapshot())
+            if not self.path.endswith('/chat/completions'):
+                return self._send(404, {'error': {'message': 'Unknown endpoint', 'type': 'invalid_request_error'}})
+
+            settings = state.snapshot()
+            with state.lock:
+                state.requests += 1
+            slow = random.random() < settings['slow_rate']
+            jitter = random.uniform(0.75, 1.25)
+            time.sleep((settings['slow_ms'] if slow else settings['latency_ms']) * jitter / 1000)
+            if random.random() < settings['error_rate']:
+                return self._send(500, {'error': {'message': 'Injected failure', 'type': 'server_error'}})
+
+            content = reply_for(body)
+            function = body['functions'][0]['name'] if body.get('functions') else None
+            if body.get('stream'):
+                return self._stream(body, content, function)
+            message = {'role': 'assistant', 'content': content}
+            if function:
+                message = {'role': 'assistant', 'content': None, 'function_call': {'name': function, 'arguments': content}}
+            self._send(200, {
+                'id': f"chatcmpl-stub-{settings['requests']}",
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model', 'stub'),
+                'choices': [{'index': 0, 'message': message, 'finish_reason': 'function_call' if function else 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(content) // 4, 'total_tokens': len(content) // 4},
+            })
+
+        def _stream(self, body, content, function):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+            for i, piece in enumerate(pieces):
+                delta = {'content': piece}
+                if function:
+                    delta = {'function_call': {'arguments': piece, **({'name': function} if i == 0 else {})}}
+                self._event({'object': 'chat.completion.chunk', 'model': body.get('model', 'stub'),
+                             'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})
+                time.sleep(0.005)
+            self._event({'object': 'chat.completion.chunk', 'model': body.get('model', 'stub'),
+                         'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'function_call' if function else 'stop'}]})
+            self.wfile.write(b'data: [DONE]\n\n')
+
+        def _event(self, chunk):
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+
+    return Handler
+
+def start_stub_server(port=0, **settings):
+    """Serve in a background thread; returns (server, state). Port 0 picks a free port."""
+    state = StubState(**settings)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=80)
+    parser.add_argument('--slow-rate', type=float, default=0.05)
+    parser.add_argument('--slow-ms', type=float, default=4000)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, _ = start_stub_server(args.port, latency_ms=args.latency_ms, slow_rate=args.slow_rate,
+                                  slow_ms=args.slow_ms, error_rate=args.error_rate)
+    print(f"Stub LLM listening on http://127.0.0.1:{server.server_address[1]}/v1")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
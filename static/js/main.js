@@ -429,9 +429,17 @@ async function submitDoubt(event) {
     
     console.log('Doubt topic:', topic, 'Question:', question, 'Image:', questionImage);
     
+    // One key per doubt, kept until it goes through, so a retry or double-click can't file it twice
+    if (!form.dataset.idempotencyKey) {
+        form.dataset.idempotencyKey = window.crypto && crypto.randomUUID
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    }
+    
     try {
         const response = await fetch('/api/doubts', {
             method: 'POST',
+            headers: { 'Idempotency-Key': form.dataset.idempotencyKey },
             body: formData // Send as FormData to handle file upload
         });
         
@@ -446,6 +454,7 @@ async function submitDoubt(event) {
         
         if (data.success) {
             showAlert('Doubt submitted successfully!');
+            delete form.dataset.idempotencyKey;
             form.reset();
             // Clear file preview
             const filePreview = document.getElementById('file-preview');